@@ -3,7 +3,7 @@ from django import forms
 from django.contrib import admin
 from django.http import HttpResponseRedirect
 from django.utils.translation import ugettext_lazy as _
-from isle.models import Event, Team, EventType, Trace
+from isle.models import Event, Team, EventType, Trace, SyncJob, SyncRun
 
 
 class RemoveDeleteActionMixin:
@@ -22,7 +22,9 @@ class EventAdmin(RemoveDeleteActionMixin, admin.ModelAdmin):
     actions = ['make_active', 'make_inactive']
     list_display = ('uid', 'title', 'dt_start', 'dt_end', 'event_type', 'is_active')
     list_filter = ('is_active', 'event_type',)
-    readonly_fields = ('uid', 'dt_start', 'dt_end', 'data', 'title', 'event_type', 'ile_id', 'ext_id')
+    readonly_fields = ('uid', 'dt_start', 'dt_end', 'data', 'title', 'event_type', 'ile_id', 'ext_id', 'fingerprint',
+                       'activity', 'run', 'run_ext_id', 'activity_ext_id', 'authors', 'entry_count', 'trace_count',
+                       'event_only_material_count')
     search_fields = ('uid', )
 
     def has_add_permission(self, request):
@@ -46,6 +48,7 @@ class TeamAdmin(RemoveDeleteActionMixin, admin.ModelAdmin):
     list_display = ('event', 'name')
     search_fields = ('name', 'event__uid', 'event__title')
     filter_horizontal = ('users', )
+    readonly_fields = ('traces_number', )
 
     def has_add_permission(self, request):
         return False
@@ -93,3 +96,24 @@ class EventTypeAdmin(RemoveDeleteActionMixin, admin.ModelAdmin):
                 if item not in added_traces:
                     Trace.objects.filter(id=trace_id).delete()
                     logging.warning('Trace #%s %s was deleted' % (trace_id, item))
+
+
+@admin.register(SyncJob)
+class SyncJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'scope', 'status', 'created_on', 'started_on', 'finished_on')
+    list_filter = ('status',)
+    readonly_fields = ('scope', 'status', 'created_on', 'started_on', 'finished_on')
+    search_fields = ('scope',)
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(SyncRun)
+class SyncRunAdmin(admin.ModelAdmin):
+    list_display = ('command', 'started_on', 'duration', 'success')
+    list_filter = ('command', 'success')
+    readonly_fields = ('command', 'started_on', 'duration', 'success', 'stats', 'phases')
+
+    def has_add_permission(self, request):
+        return False
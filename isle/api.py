@@ -1,10 +1,123 @@
+import codecs
+import json
 import logging
+import random
+import threading
+import time
 from django.conf import settings
-from django.core.cache import caches
+from django.core.cache import cache
 from django.utils import timezone
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+from isle.locks import single_flight
+from isle.telemetry import phase, timed
 
-DEFAULT_CACHE = caches['default']
+# прокси, а не сам бэкенд, чтобы подмена CACHES (например, в benchmark_sync) действовала и здесь
+DEFAULT_CACHE = cache
+
+_session = None
+_session_lock = threading.Lock()
+# методы, запросы которыми можно безопасно повторять
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def make_session(adapter_class=HTTPAdapter):
+    """
+    сессия с пулом keep-alive соединений, размеры пула задаются настройками ILE_POOL_CONNECTIONS
+    (количество хостов) и ILE_POOL_MAXSIZE (соединений на хост)
+    """
+    session = requests.Session()
+    adapter = adapter_class(pool_connections=getattr(settings, 'ILE_POOL_CONNECTIONS', 4),
+                            pool_maxsize=getattr(settings, 'ILE_POOL_MAXSIZE', 10))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    return session
+
+
+def get_session():
+    """
+    общая для всех запросов к внешним сервисам сессия, создается при первом обращении
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = make_session()
+    return _session
+
+
+def set_session(session):
+    """
+    замена общей сессии, например на сессию с транспортом из isle.testing
+    """
+    global _session
+    with _session_lock:
+        _session = session
+
+
+def is_not_sent(exc):
+    """
+    ошибка установки соединения, при которой запрос точно не был отправлен
+    """
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    reason = getattr(exc.args[0], 'reason', None) if exc.args else None
+    return isinstance(reason, ConnectTimeoutError)
+
+
+def send_request(method, url, **kwargs):
+    """
+    запрос через общую сессию. При ошибке соединения или ответе 5xx запрос повторяется до
+    ILE_MAX_RETRIES раз с экспоненциально растущей паузой со случайным разбросом. Неидемпотентные
+    запросы (например, POST) повторяются, только если соединение не удалось установить. Если попытки
+    закончились, пробрасывается последнее исключение или возвращается последний ответ
+    """
+    retries = getattr(settings, 'ILE_MAX_RETRIES', 3)
+    backoff = getattr(settings, 'ILE_RETRY_BACKOFF', 0.5)
+    backoff_max = getattr(settings, 'ILE_RETRY_BACKOFF_MAX', 10)
+    idempotent = method.upper() in IDEMPOTENT_METHODS
+    for attempt in range(retries + 1):
+        try:
+            r = get_session().request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= retries or not (idempotent or is_not_sent(e)):
+                raise
+            reason = 'connection failure'
+        else:
+            if r.status_code < 500 or attempt >= retries or not idempotent:
+                return r
+            r.close()
+            reason = 'code %s' % r.status_code
+        delay = random.uniform(0, min(backoff_max, backoff * 2 ** attempt))
+        logging.warning('Request to %s failed (%s), retry in %.2fs' % (url, reason, delay))
+        time.sleep(delay)
+
+
+class TokenBucket:
+    """
+    ограничение частоты запросов: в среднем не более rate запросов в секунду с допустимым всплеском
+    до capacity запросов. Один объект можно использовать из нескольких потоков
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = capacity or max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
 
 
 class ApiError(Exception):
@@ -15,34 +128,243 @@ class ApiNotFound(ApiError):
     pass
 
 
+def get_conditional_headers(cache_key):
+    """
+    заголовки условного запроса по сохраненным в кеше валидаторам (ETag/Last-Modified) ответа
+    """
+    validators = DEFAULT_CACHE.get(cache_key) or {}
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def get_validators(response):
+    return {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+
+
+def save_validators(cache_key, validators):
+    """
+    сохранение валидаторов ответа; делается только после успешной обработки ответа, чтобы при
+    ошибке следующий запрос не получил 304 на необработанные данные
+    """
+    DEFAULT_CACHE.set(cache_key, validators or {}, timeout=None)
+
+
+class JsonStream:
+    """
+    Инкрементальный разбор json-документа, приходящего частями (строками или байтами в utf-8).
+    Позволяет по одному получать элементы списка, лежащего в объекте верхнего уровня, не загружая
+    документ в память целиком: в буфере держится только еще не разобранный остаток
+    """
+    WHITESPACE = ' \t\n\r'
+    DELIMITERS = WHITESPACE + ',]}'
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self, min_size=1):
+        """
+        дочитывает в буфер как минимум min_size символов, возвращает False, если документ закончился
+        """
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        read = 0
+        for chunk in self.chunks:
+            if isinstance(chunk, bytes):
+                chunk = self.text_decoder.decode(chunk)
+            self.buf += chunk
+            read += len(chunk)
+            if read >= min_size:
+                return True
+        self.buf += self.text_decoder.decode(b'', final=True)
+        self.eof = True
+        return read > 0
+
+    def peek(self):
+        """
+        следующий непробельный символ (без его извлечения) или пустая строка в конце документа
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in self.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof or not self.read_more():
+                return ''
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError('Expected one of %r, got %r' % (chars, c or 'end of document'))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """
+        разбор очередного json-значения целиком
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                # значение еще не скачано до конца, дочитываем как минимум столько же, сколько уже есть
+                if self.eof or not self.read_more(len(self.buf) - self.pos):
+                    raise
+                continue
+            # число могло оборваться на границе частей (в том числе после '.', 'e' или '-0'), поэтому
+            # оно принимается, только если за ним идет разделитель или документ закончился
+            if isinstance(value, (int, float)) and not self.eof and \
+                    (end == len(self.buf) or self.buf[end] not in self.DELIMITERS) and self.read_more():
+                continue
+            self.pos = end
+            return value
+
+    def iter_list(self, key):
+        """
+        элементы списка, лежащего по ключу key в объекте верхнего уровня
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            return
+        while True:
+            name = self.value()
+            self.expect(':')
+            if name == key and self.peek() == '[':
+                self.pos += 1
+                if self.peek() == ']':
+                    self.pos += 1
+                else:
+                    while True:
+                        yield self.value()
+                        if self.expect(',]') == ']':
+                            break
+            else:
+                self.value()
+            if self.expect(',}') == '}':
+                return
+
+
+class TokenStore:
+    """
+    Токен ILE в памяти процесса вместе со временем его истечения. Когда до истечения остается меньше
+    ILE_TOKEN_RENEW_BEFORE секунд (но не больше половины времени жизни токена), он обновляется
+    в фоновом потоке, а до тех пор используется текущий. Полученный токен сохраняется в кеш, откуда
+    его берут другие процессы
+    """
+    def __init__(self, cache_key):
+        self.cache_key = cache_key
+        self.token = None
+        self.expires = 0
+        self.renew_at = 0
+        self.renewing = False
+        self.lock = threading.Lock()
+
+    def get(self):
+        """
+        действующий токен или None, если его надо получить заново
+        """
+        with self.lock:
+            now = time.time()
+            if self.token is None or self.expires <= now:
+                self.token, self.expires, self.renew_at = self.load()
+            if self.token is not None and self.renew_at <= now and not self.renewing:
+                self.renewing = True
+                threading.Thread(target=self.renew, daemon=True).start()
+            return self.token
+
+    def load(self):
+        value = DEFAULT_CACHE.get(self.cache_key)
+        if isinstance(value, (list, tuple)) and len(value) == 3 and value[1] > time.time():
+            return tuple(value)
+        return None, 0, 0
+
+    def set(self, token, expires, renew_at):
+        with self.lock:
+            self.token, self.expires, self.renew_at = token, expires, renew_at
+
+    def save(self, token, duration):
+        now = time.time()
+        value = (token, now + duration, now + duration - min(getattr(settings, 'ILE_TOKEN_RENEW_BEFORE', 60),
+                                                             duration / 2))
+        DEFAULT_CACHE.set(self.cache_key, value, timeout=int(duration))
+        self.set(*value)
+
+    def invalidate(self, token):
+        """
+        сброс токена, который ILE отклонил
+        """
+        with self.lock:
+            if self.token == token:
+                self.token, self.expires, self.renew_at = None, 0, 0
+        if self.load()[0] == token:
+            DEFAULT_CACHE.delete(self.cache_key)
+
+    def renew(self):
+        try:
+            Api().refresh_token()
+        except ApiError:
+            pass
+        finally:
+            with self.lock:
+                self.renewing = False
+
+
 class Api:
     """
     класс, реализующий запрос к ручке ILE с поддержкой получения и хранения токена, а также
     его обновлением по истечении его действия
     """
     TOKEN_CACHE_KEY = 'ILE_TOKEN'
+    TOKEN_LOCK = 'ILE_TOKEN'
     EVENTS_DATA_CACHE_KEY = 'EVENTS_DATA'
+    EVENTS_VALIDATORS_CACHE_KEY = 'EVENTS_DATA_VALIDATORS'
     LAST_FETCH_CACHE_KEY = 'LAST_TIME_FETCHED'
     MAX_RETRIES = 2
+    SNAPSHOT_CHUNK_SIZE = 64 * 1024
 
     def __init__(self):
-        self.token = self.get_token()
+        self.events_validators = None
 
-    def get_token(self):
-        return DEFAULT_CACHE.get(self.TOKEN_CACHE_KEY)
+    @property
+    def token(self):
+        return _token_store.get()
 
     def refresh_token(self):
+        """
+        получение нового токена. Одновременно токен запрашивает только один процесс, остальные
+        дожидаются его и берут полученный токен из кеша
+        """
+        stale_token = self.token
+        lease = settings.CONNECTION_TIMEOUT * (getattr(settings, 'ILE_MAX_RETRIES', 3) + 1)
+        with single_flight(self.TOKEN_LOCK, lease=lease, wait=lease):
+            token, expires, renew_at = _token_store.load()
+            if token and token != stale_token:
+                _token_store.set(token, expires, renew_at)
+                return token
+            return self.fetch_token()
+
+    def fetch_token(self):
         try:
-            r = requests.get(
+            r = send_request(
+                'get',
                 '{}{}'.format(settings.ILE_BASE_URL, settings.ILE_TOKEN_PATH),
                 auth=settings.ILE_TOKEN_USER,
                 timeout=settings.CONNECTION_TIMEOUT,
                 verify=settings.ILE_VERIFY_CERTIFICATE,
             )
             assert r.ok
-            DEFAULT_CACHE.set(self.TOKEN_CACHE_KEY, r.json()['token'], timeout=int(r.json()['duration']))
-            self.token = r.json()['token']
-            return r.json()['token']
+            data = r.json()
+            _token_store.save(data['token'], int(data['duration']))
+            return data['token']
         except AssertionError:
             logging.error('ILE returned code %s, reason: %s' % (r.status_code, r.reason))
             raise ApiError
@@ -61,25 +383,37 @@ class Api:
                          or val is None
             if not do_refresh:
                 return val, False
+        # если снэпшот есть в кеше, запрос делается условным, и при ответе 304 возвращается снэпшот из кеша
+        cached = DEFAULT_CACHE.get(self.EVENTS_DATA_CACHE_KEY)
         try:
-            if not self.token:
-                self.refresh_token()
-            r = requests.get(
-                '{}{}'.format(settings.ILE_BASE_URL, settings.ILE_SNAPSHOT_PATH),
-                headers={'Authorization': 'Bearer %s' % self.token},
-                timeout=settings.CONNECTION_TIMEOUT,
-                verify=settings.ILE_VERIFY_CERTIFICATE,
-            )
+            token = self.token or self.refresh_token()
+            headers = {'Authorization': 'Bearer %s' % token}
+            if cached is not None:
+                headers.update(get_conditional_headers(self.EVENTS_VALIDATORS_CACHE_KEY))
+            with phase('download'):
+                r = send_request(
+                    'get',
+                    '{}{}'.format(settings.ILE_BASE_URL, settings.ILE_SNAPSHOT_PATH),
+                    headers=headers,
+                    timeout=settings.CONNECTION_TIMEOUT,
+                    verify=settings.ILE_VERIFY_CERTIFICATE,
+                )
             if r.status_code == 401:
+                _token_store.invalidate(token)
                 if retry < self.MAX_RETRIES:
                     return self.get_events_data(force=force, retry=retry + 1)
                 else:
                     raise ApiError
             elif r.status_code == 404:
                 raise ApiNotFound
+            elif r.status_code == 304:
+                return cached, False
             assert r.ok
-            DEFAULT_CACHE.set(self.EVENTS_DATA_CACHE_KEY, r.json(), timeout=settings.API_DATA_CACHE_TIME)
-            return r.json(), True
+            with phase('decode'):
+                data = r.json()
+            DEFAULT_CACHE.set(self.EVENTS_DATA_CACHE_KEY, data, timeout=settings.API_DATA_CACHE_TIME)
+            self.events_validators = get_validators(r)
+            return data, True
         except AssertionError:
             logging.error('ILE returned code %s, reason: %s' % (r.status_code, r.reason))
             raise ApiError
@@ -87,39 +421,106 @@ class Api:
             logging.exception('ILE connection failure')
             raise ApiError
 
-    def get_paginated_activities(self, page):
-        return self.make_request(
-            '{}/api/activity/list/'.format(settings.ILE_BASE_URL),
-            params={
-                '_I': ['activity.runs',
-                       'run.assignments',
-                       'assignment.user',
-                       'run.events',
-                       'event.time_slot',
-                       'event.check_ins',
-                       'check_in.user'],
-                '_per_page': getattr(settings, 'ACTIVITIES_PER_PAGE', 20),
-                '_page': page
-            }
-        )
+    def get_events_stream(self, conditional=True, retry=0):
+        """
+        потоковое получение снэпшота: возвращает итератор по активностям, которые разбираются
+        из тела ответа по одной по мере скачивания, и признак того, что снэпшот изменился. Снэпшот
+        целиком не хранится ни в памяти, ни в кеше. При conditional=True запрос делается условным,
+        и если снэпшот не изменился с последней успешной обработки, возвращается (None, False)
+        """
+        try:
+            token = self.token or self.refresh_token()
+            headers = {'Authorization': 'Bearer %s' % token}
+            if conditional:
+                headers.update(get_conditional_headers(self.EVENTS_VALIDATORS_CACHE_KEY))
+            with phase('download'):
+                r = send_request(
+                    'get',
+                    '{}{}'.format(settings.ILE_BASE_URL, settings.ILE_SNAPSHOT_PATH),
+                    headers=headers,
+                    timeout=settings.CONNECTION_TIMEOUT,
+                    verify=settings.ILE_VERIFY_CERTIFICATE,
+                    stream=True,
+                )
+            if r.status_code == 401:
+                r.close()
+                _token_store.invalidate(token)
+                if retry < self.MAX_RETRIES:
+                    return self.get_events_stream(conditional=conditional, retry=retry + 1)
+                else:
+                    raise ApiError
+            elif r.status_code == 404:
+                r.close()
+                raise ApiNotFound
+            elif r.status_code == 304:
+                r.close()
+                return None, False
+            assert r.ok
+        except AssertionError:
+            logging.error('ILE returned code %s, reason: %s' % (r.status_code, r.reason))
+            r.close()
+            raise ApiError
+        except requests.RequestException:
+            logging.exception('ILE connection failure')
+            raise ApiError
+        self.events_validators = get_validators(r)
+        return self._iter_activities(r), True
+
+    def save_events_validators(self):
+        """
+        сохранение валидаторов полученного снэпшота, вызывается после его успешной обработки
+        """
+        if self.events_validators is not None:
+            save_validators(self.EVENTS_VALIDATORS_CACHE_KEY, self.events_validators)
+
+    def _iter_activities(self, r):
+        try:
+            for activity in JsonStream(timed(r.iter_content(self.SNAPSHOT_CHUNK_SIZE), 'download')).iter_list('activities'):
+                yield activity
+        except requests.RequestException:
+            logging.exception('ILE connection failure')
+            raise ApiError
+        finally:
+            r.close()
+
+    def get_paginated_activities(self, page, updated_since=None):
+        """
+        страница активностей, при указании updated_since - только измененных с этого момента
+        """
+        params = {
+            '_I': ['activity.runs',
+                   'run.assignments',
+                   'assignment.user',
+                   'run.events',
+                   'event.time_slot',
+                   'event.check_ins',
+                   'check_in.user'],
+            '_per_page': getattr(settings, 'ACTIVITIES_PER_PAGE', 20),
+            '_page': page
+        }
+        if updated_since is not None:
+            params[getattr(settings, 'ILE_UPDATED_SINCE_PARAM', 'updated_since')] = updated_since.isoformat()
+        return self.make_request('{}/api/activity/list/'.format(settings.ILE_BASE_URL), params=params)
 
     def make_request(self, url, method='get', retry=0, **kwargs):
         try:
-            if not self.token:
-                self.refresh_token()
-            r = requests.request(
+            token = self.token or self.refresh_token()
+            r = send_request(
                 method,
                 url,
-                headers={'Authorization': 'Bearer %s' % self.token},
+                headers={'Authorization': 'Bearer %s' % token},
                 timeout=settings.CONNECTION_TIMEOUT,
                 verify=settings.ILE_VERIFY_CERTIFICATE,
                 **kwargs
             )
             if r.status_code == 401:
+                _token_store.invalidate(token)
                 if retry < self.MAX_RETRIES:
-                    return self.make_request(url, method=method, retry=retry + 1)
+                    return self.make_request(url, method=method, retry=retry + 1, **kwargs)
                 else:
                     raise ApiError
+            elif r.status_code == 404:
+                raise ApiNotFound
             assert r.ok
             return r.json()
         except AssertionError:
@@ -140,3 +541,6 @@ class Api:
                 settings.ILE_BASE_URL, unti_id, event_id, int(bool(confirmed))),
             method='post'
         )
+
+
+_token_store = TokenStore(Api.TOKEN_CACHE_KEY)
@@ -0,0 +1,8 @@
+from django.apps import AppConfig
+
+
+class IsleConfig(AppConfig):
+    name = 'isle'
+
+    def ready(self):
+        from isle import signals  # noqa
@@ -0,0 +1,82 @@
+from collections import Counter
+from django.db import transaction
+from django.db.models import Count, F
+from isle.db import BATCH_SIZE, chunks, count_subquery
+from isle.models import Event, EventEntry, EventMaterial, EventOnlyMaterial, EventTeamMaterial, MaterialCounter, \
+    Team, User
+
+MATERIAL_MODELS = (EventMaterial, EventTeamMaterial, EventOnlyMaterial)
+
+
+def is_user_material(material):
+    """
+    материал загружен пользователем, а не ассистентом. Как и в сводке на главной странице,
+    initiator сравнивается с id ассистентов
+    """
+    if isinstance(material, EventOnlyMaterial) or material.initiator is None:
+        return False
+    return not User.objects.filter(id=material.initiator, is_assistant=True).exists()
+
+
+def add_to_counter(queryset, field, delta):
+    """
+    изменение счетчика field на delta одним запросом без ухода в минус. Возвращает количество
+    измененных строк
+    """
+    if delta < 0:
+        queryset = queryset.filter(**{'%s__gte' % field: -delta})
+    return queryset.update(**{field: F(field) + delta})
+
+
+def update_material_counters(material, delta):
+    """
+    изменение на delta счетчиков эвента, команды и сводки материалов, в которые входит material
+    """
+    events = Event.objects.filter(id=material.event_id)
+    add_to_counter(events, 'trace_count', delta)
+    if isinstance(material, EventOnlyMaterial):
+        add_to_counter(events, 'event_only_material_count', delta)
+    if isinstance(material, EventTeamMaterial):
+        add_to_counter(Team.objects.filter(id=material.team_id), 'traces_number', delta)
+    is_user = is_user_material(material)
+    counters = MaterialCounter.objects.filter(event_id=material.event_id, is_user=is_user)
+    if not add_to_counter(counters, 'num', delta) and delta > 0:
+        MaterialCounter.objects.get_or_create(event_id=material.event_id, is_user=is_user)
+        add_to_counter(counters, 'num', delta)
+
+
+def rebuild_material_counters(batch_size=BATCH_SIZE):
+    assistants = User.objects.filter(is_assistant=True).values_list('id', flat=True)
+    counts = Counter()
+    for model in MATERIAL_MODELS:
+        for event_id, num in model.objects.values_list('event_id').annotate(num=Count('id')):
+            counts[(event_id, False)] += num
+        if model is EventOnlyMaterial:
+            continue
+        user_materials = model.objects.exclude(initiator__isnull=True).exclude(initiator__in=assistants)
+        for event_id, num in user_materials.values_list('event_id').annotate(num=Count('id')):
+            counts[(event_id, True)] += num
+            counts[(event_id, False)] -= num
+    MaterialCounter.objects.all().delete()
+    MaterialCounter.objects.bulk_create([MaterialCounter(event_id=event_id, is_user=is_user, num=num)
+                                         for (event_id, is_user), num in counts.items() if num],
+                                        batch_size=batch_size)
+
+
+def rebuild_counters(batch_size=BATCH_SIZE):
+    """
+    пересчет всех счетчиков записей и материалов по текущим данным
+    """
+    with transaction.atomic():
+        for batch in chunks(Event.objects.values_list('id', flat=True), batch_size):
+            Event.objects.filter(id__in=batch).update(
+                entry_count=count_subquery(EventEntry.objects.all(), 'event'),
+                trace_count=(count_subquery(EventMaterial.objects.all(), 'event') +
+                             count_subquery(EventTeamMaterial.objects.all(), 'event') +
+                             count_subquery(EventOnlyMaterial.objects.all(), 'event')),
+                event_only_material_count=count_subquery(EventOnlyMaterial.objects.all(), 'event'),
+            )
+        for batch in chunks(Team.objects.values_list('id', flat=True), batch_size):
+            Team.objects.filter(id__in=batch).update(
+                traces_number=count_subquery(EventTeamMaterial.objects.all(), 'team'))
+        rebuild_material_counters(batch_size)
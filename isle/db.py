@@ -0,0 +1,52 @@
+from django.db import connection
+from django.db.models import Case, Count, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from isle.models import Event, EventEntry
+
+# размер пачки для bulk_create/bulk_update и для условий вида id__in
+BATCH_SIZE = 500
+
+
+def chunks(items, size=BATCH_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def bulk_update(objs, fields, batch_size=BATCH_SIZE):
+    """
+    обновление полей fields у объектов objs одним запросом на пачку (аналог QuerySet.bulk_update
+    из django 2.2). Возвращает количество обновленных строк
+    """
+    objs = list(objs)
+    if not objs:
+        return 0
+    model = type(objs[0])
+    fields = [model._meta.get_field(name) for name in fields]
+    # на каждый объект приходится по два параметра на поле и еще один в условии pk__in
+    max_batch_size = connection.ops.bulk_batch_size(['pk', 'pk'] * len(fields) + ['pk'], objs)
+    batch_size = min(batch_size, max_batch_size) if max_batch_size else batch_size
+    updated = 0
+    for batch in chunks(objs, batch_size):
+        update_kwargs = {}
+        for field in fields:
+            whens = [When(pk=obj.pk, then=Value(getattr(obj, field.attname), output_field=field)) for obj in batch]
+            update_kwargs[field.name] = Case(*whens, output_field=field)
+        updated += model._base_manager.filter(pk__in=[obj.pk for obj in batch]).update(**update_kwargs)
+    return updated
+
+
+def count_subquery(queryset, field, outer_field='pk'):
+    """
+    количество строк queryset, у которых field равно outer_field внешнего запроса, для update/annotate
+    """
+    queryset = queryset.filter(**{field: OuterRef(outer_field)}).order_by().values(field).annotate(num=Count('pk'))
+    return Coalesce(Subquery(queryset.values('num')), Value(0))
+
+
+def update_entry_counts(event_ids, batch_size=BATCH_SIZE):
+    """
+    пересчет счетчика записей у эвентов event_ids (bulk_create и update записей обходят сигналы)
+    """
+    for batch in chunks(set(event_ids), batch_size):
+        Event.objects.filter(id__in=batch).update(entry_count=count_subquery(EventEntry.objects.all(), 'event'))
@@ -0,0 +1,71 @@
+import logging
+from django.conf import settings
+from django.utils import timezone
+from isle.models import SyncJob
+from isle.utils import refresh_events_data
+
+
+def fail_stale_jobs():
+    """
+    задачи, выполняющиеся дольше SYNC_JOB_TIMEOUT секунд, считаются упавшими вместе с обработчиком
+    """
+    dt = timezone.now() - timezone.timedelta(seconds=getattr(settings, 'SYNC_JOB_TIMEOUT', 3600))
+    return SyncJob.objects.filter(status=SyncJob.STATUS_RUNNING, started_on__lt=dt).update(
+        status=SyncJob.STATUS_FAILED, finished_on=timezone.now())
+
+
+def enqueue_refresh(uid=None):
+    """
+    постановка задачи на обновление всех эвентов или эвента с указанным uid. Если задача для этой
+    же области уже ожидает выполнения или выполняется, новая не создается и возвращается существующая
+    """
+    fail_stale_jobs()
+    scope = uid or ''
+    job = SyncJob.objects.filter(
+        scope=scope, status__in=[SyncJob.STATUS_PENDING, SyncJob.STATUS_RUNNING]).order_by('id').first()
+    if job is None:
+        # при одновременных запросах вторая вставка нарушит уникальность pending_scope, и get_or_create
+        # вернет уже созданную задачу
+        job, _ = SyncJob.objects.get_or_create(pending_scope=scope, defaults={'scope': scope})
+    return job
+
+
+def claim_job():
+    """
+    получение следующей ожидающей задачи. Статус меняется условным update, поэтому одну задачу
+    не возьмут несколько обработчиков
+    """
+    for job in SyncJob.objects.filter(status=SyncJob.STATUS_PENDING).order_by('id'):
+        if SyncJob.objects.filter(id=job.id, status=SyncJob.STATUS_PENDING).update(
+                status=SyncJob.STATUS_RUNNING, started_on=timezone.now(), pending_scope=None):
+            job.status = SyncJob.STATUS_RUNNING
+            return job
+
+
+def run_job(job):
+    try:
+        if job.scope:
+            success = refresh_events_data(force=True, refresh_participants=True, refresh_for_events=[job.scope])
+        else:
+            success = refresh_events_data(force=True)
+    except Exception:
+        logging.exception('Sync job %s failed' % job.id)
+        success = False
+    job.status = SyncJob.STATUS_DONE if success else SyncJob.STATUS_FAILED
+    job.finished_on = timezone.now()
+    SyncJob.objects.filter(id=job.id).update(status=job.status, finished_on=job.finished_on)
+    return success
+
+
+def run_pending_jobs():
+    """
+    выполнение всех ожидающих задач, возвращает количество выполненных
+    """
+    fail_stale_jobs()
+    num = 0
+    job = claim_job()
+    while job is not None:
+        run_job(job)
+        num += 1
+        job = claim_job()
+    return num
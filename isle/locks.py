@@ -0,0 +1,109 @@
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from isle.models import SyncLock
+
+
+class DbLock:
+    """
+    Блокировка между процессами через строку SyncLock: захват - атомарный условный update (или создание
+    строки), поэтому она работает при любом бэкенде кеша. Блокировка выдается на lease секунд: если
+    владелец упал, не освободив ее, она снимется сама по истечении этого времени. При освобождении
+    сохраняется result владельца, который могут получить дождавшиеся его процессы (см. wait_result)
+    """
+    def __init__(self, name, lease):
+        self.name = name
+        self.lease = lease
+        self.token = None
+        self.result = None
+
+    def try_acquire(self):
+        token = uuid.uuid4().hex
+        now = timezone.now()
+        values = {'token': token, 'expires_on': now + timedelta(seconds=self.lease)}
+        acquired = SyncLock.objects.filter(name=self.name, expires_on__lte=now).update(**values)
+        if not acquired:
+            try:
+                with transaction.atomic():
+                    SyncLock.objects.create(name=self.name, **values)
+                acquired = True
+            except IntegrityError:
+                pass
+        if acquired:
+            self.token = token
+        return bool(acquired)
+
+    def acquire(self, wait=0, poll=0.1):
+        """
+        попытка захватить блокировку в течение wait секунд, возвращает True, если удалось
+        """
+        deadline = time.monotonic() + wait
+        while True:
+            if self.try_acquire():
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(poll)
+
+    def release(self):
+        if self.token is not None:
+            SyncLock.objects.filter(name=self.name, token=self.token).update(
+                token='', expires_on=timezone.now(), result=self.result)
+        self.token = None
+
+    def is_locked(self):
+        return SyncLock.objects.filter(name=self.name, expires_on__gt=timezone.now()).exists()
+
+    def get_state(self):
+        return SyncLock.objects.filter(name=self.name).values('token', 'expires_on', 'result').first()
+
+    def wait_result(self, timeout, poll=1):
+        """
+        ожидание освобождения блокировки текущим владельцем не дольше timeout секунд. Возвращает его
+        result или None, если владелец не освободил блокировку вовремя
+        """
+        state = self.get_state()
+        holder = state and state['token']
+        deadline = time.monotonic() + timeout
+        while state is not None:
+            if state['token'] != holder or not state['token']:
+                return state['result']
+            if state['expires_on'] <= timezone.now() or time.monotonic() >= deadline:
+                return None
+            time.sleep(poll)
+            state = self.get_state()
+
+
+@contextmanager
+def single_flight(name, lease, wait=0):
+    """
+    выполнение блока только одним процессом одновременно: остальные ждут освобождения блокировки
+    не дольше wait секунд. В блок передается признак того, что блокировка захвачена
+    """
+    lock = DbLock(name, lease)
+    acquired = lock.acquire(wait=wait)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            lock.release()
+
+
+def call_single_flight(name, lease, func, *args, **kwargs):
+    """
+    вызов func только одним процессом одновременно. Вызовы, пришедшие во время уже идущего, не повторяют
+    его, а дожидаются его окончания (не дольше lease секунд) и возвращают его результат
+    """
+    lock = DbLock(name, lease)
+    if not lock.acquire():
+        logging.warning('%s is already running, waiting for its result' % name)
+        return lock.wait_result(timeout=lease)
+    try:
+        lock.result = func(*args, **kwargs)
+        return lock.result
+    finally:
+        lock.release()
@@ -0,0 +1,141 @@
+import time
+import tracemalloc
+from io import StringIO
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import override_settings, setup_databases, teardown_databases
+from isle.api import _token_store
+from isle.models import EventEntry, User
+from isle.testing import USERS_UNTI_ID_FROM, StubServer, make_activities, make_traces
+from isle.utils import refresh_events_data, refresh_events_data_v2, update_events_traces
+
+
+class Command(BaseCommand):
+    help = 'Замер синхронизации с ILE и LABS на синтетических данных локального сервера-заглушки: время, ' \
+           'количество запросов к базе, записанных строк и пиковая память. Замер идет на временной базе ' \
+           'и локальных кешах, рабочие база и кеши не затрагиваются'
+
+    PATHS = ['snapshot', 'stream', 'v2', 'traces', 'push_check_ins']
+
+    def add_arguments(self, parser):
+        parser.add_argument('--activities', type=int, default=50)
+        parser.add_argument('--runs', type=int, default=2, help='Прогонов в активности')
+        parser.add_argument('--events', type=int, default=3, help='Эвентов в прогоне')
+        parser.add_argument('--participants', type=int, default=20, help='Участников прогона')
+        parser.add_argument('--users', type=int, default=500, help='Всего пользователей')
+        parser.add_argument('--check-ins', type=int, default=5, help='Чекинов на эвенте')
+        parser.add_argument('--traces', type=int, default=50)
+        parser.add_argument('--events-per-trace', type=int, default=10)
+        parser.add_argument('--latency', type=float, default=0, help='Задержка ответа заглушки в секундах')
+        parser.add_argument('--paths', nargs='+', choices=self.PATHS, default=self.PATHS)
+        parser.add_argument('--repeat', action='store_true', default=False,
+                            help='Повторить каждую синхронизацию на неизменившихся данных')
+        parser.add_argument('--no-memory', action='store_true', default=False,
+                            help='Не замерять память (tracemalloc замедляет работу)')
+
+    def handle(self, *args, **options):
+        activities = make_activities(options['activities'], options['runs'], options['events'],
+                                     options['participants'], options['users'], options['check_ins'])
+        traces = make_traces(activities, options['traces'], options['events_per_trace'])
+        self.server = StubServer(activities, traces, latency=options['latency'])
+        self.server.start()
+        self.memory = not options['no_memory']
+        # все алиасы кешей подменяются на локальные, чтобы индекс эвентов, блокировки, токен и валидаторы
+        # не попадали в рабочий кеш
+        benchmark_caches = {alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                    'LOCATION': 'benchmark_sync_%s' % alias,
+                                    'OPTIONS': {'MAX_ENTRIES': 10 ** 6}} for alias in settings.CACHES}
+        results = []
+        try:
+            with override_settings(ILE_BASE_URL=self.server.url, ILE_TOKEN_PATH=StubServer.TOKEN_PATH,
+                                   ILE_SNAPSHOT_PATH=StubServer.SNAPSHOT_PATH,
+                                   LABS_TRACES_API_URL=self.server.url + StubServer.TRACES_PATH,
+                                   CACHES=benchmark_caches):
+                old_config = setup_databases(verbosity=0, interactive=False)
+                try:
+                    with transaction.atomic():
+                        User.objects.bulk_create([
+                            User(username='benchmark_%s' % (USERS_UNTI_ID_FROM + i),
+                                 unti_id=USERS_UNTI_ID_FROM + i, icon={}) for i in range(options['users'])
+                        ])
+                        for path in options['paths']:
+                            sid = transaction.savepoint()
+                            self.reset_cache()
+                            getattr(self, 'setup_%s' % path, lambda: None)()
+                            run = getattr(self, 'run_%s' % path)
+                            results.append((path, self.measure(run)))
+                            if options['repeat']:
+                                results.append(('%s (repeat)' % path, self.measure(run)))
+                            transaction.savepoint_rollback(sid)
+                        transaction.set_rollback(True)
+                finally:
+                    self.reset_cache()
+                    teardown_databases(old_config, verbosity=0)
+        finally:
+            _token_store.set(None, 0, 0)
+            self.server.stop()
+        self.stdout.write('%-24s %10s %10s %10s %12s %10s' % ('path', 'time, s', 'queries', 'rows', 'memory, MB',
+                                                              'requests'))
+        for path, r in results:
+            self.stdout.write('%-24s %10.2f %10d %10d %12s %10d' % (
+                path, r['time'], r['queries'], r['rows'],
+                '%.1f' % (r['memory'] / 1024 / 1024) if r['memory'] is not None else '-', r['requests']))
+
+    def reset_cache(self):
+        for alias in settings.CACHES:
+            caches[alias].clear()
+        _token_store.set(None, 0, 0)
+
+    def measure(self, func):
+        """
+        выполнение func с подсчетом запросов к базе, измененных ими строк, запросов к заглушке
+        и пиковой памяти
+        """
+        result = {'queries': 0, 'rows': 0, 'memory': None}
+
+        def count_queries(execute, sql, params, many, context):
+            value = execute(sql, params, many, context)
+            result['queries'] += 1
+            if sql.lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+                result['rows'] += max(context['cursor'].rowcount, 0)
+            return value
+
+        requests_before = sum(self.server.counters.values())
+        if self.memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        with connection.execute_wrapper(count_queries):
+            func()
+        result['time'] = time.perf_counter() - started
+        if self.memory:
+            result['memory'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        result['requests'] = sum(self.server.counters.values()) - requests_before
+        return result
+
+    def run_snapshot(self):
+        refresh_events_data(force=True, refresh_participants=True, stream=False)
+
+    def run_stream(self):
+        refresh_events_data(force=True, refresh_participants=True, stream=True)
+
+    def run_v2(self):
+        refresh_events_data_v2()
+
+    def setup_traces(self):
+        refresh_events_data(force=True, refresh_participants=True, stream=True)
+
+    def run_traces(self):
+        update_events_traces()
+
+    def setup_push_check_ins(self):
+        refresh_events_data(force=True, refresh_participants=True, stream=True)
+        EventEntry.objects.filter(added_by_assistant=True, check_in_pushed=False).update(check_in_pushed=True)
+        EventEntry.objects.filter(user__unti_id__gte=USERS_UNTI_ID_FROM).update(
+            added_by_assistant=True, check_in_pushed=False)
+
+    def run_push_check_ins(self):
+        call_command('push_check_ins', rate=0, stdout=StringIO())
@@ -1,5 +1,11 @@
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from django.conf import settings
 from django.core.management.base import BaseCommand
+from isle.api import Api, TokenBucket
+from isle.db import BATCH_SIZE
 from isle.models import EventEntry
 from isle.utils import set_check_in
 
@@ -7,13 +13,50 @@ from isle.utils import set_check_in
 class Command(BaseCommand):
     help = 'Проставить в ILE чекины пользователей, добавленных вручную'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Количество одновременных запросов в ILE, по умолчанию PUSH_CHECK_INS_WORKERS')
+        parser.add_argument('--rate', type=float, default=None,
+                            help='Не более стольких запросов в секунду (0 - без ограничения), '
+                                 'по умолчанию PUSH_CHECK_INS_RATE')
+
     def handle(self, *args, **options):
-        for e in EventEntry.objects.select_related('user', 'event').filter(
-                added_by_assistant=True, check_in_pushed=False).iterator():
-            if set_check_in(e.event, e.user, True):
-                EventEntry.objects.filter(id=e.id).update(check_in_pushed=True)
-                logging.info('Check in for user %s on event %s has been successfully pushed' %
-                             (e.user.username, e.event_id))
-            else:
-                logging.info('Failed to push check in for user %s on event %s' %
-                             (e.user.username, e.event_id))
+        workers = max(options['workers'] or getattr(settings, 'PUSH_CHECK_INS_WORKERS', 4), 1)
+        rate = options['rate']
+        if rate is None:
+            rate = getattr(settings, 'PUSH_CHECK_INS_RATE', 10)
+        bucket = TokenBucket(rate) if rate > 0 else None
+        api = Api()
+
+        def push(e):
+            if bucket is not None:
+                bucket.acquire()
+            return e, set_check_in(e.event, e.user, True, api=api)
+
+        entries = EventEntry.objects.select_related('user', 'event').filter(
+            added_by_assistant=True, check_in_pushed=False).iterator()
+        started = time.time()
+        pushed = failed = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                batch = list(islice(entries, BATCH_SIZE))
+                if not batch:
+                    break
+                success = []
+                for e, ok in executor.map(push, batch):
+                    if ok:
+                        success.append(e.id)
+                        logging.info('Check in for user %s on event %s has been successfully pushed' %
+                                     (e.user.username, e.event_id))
+                    else:
+                        logging.info('Failed to push check in for user %s on event %s' %
+                                     (e.user.username, e.event_id))
+                EventEntry.objects.filter(id__in=success).update(check_in_pushed=True)
+                pushed += len(success)
+                failed += len(batch) - len(success)
+                elapsed = time.time() - started
+                logging.info('Check ins pushed: %s, failed: %s, %.1f requests/s' %
+                             (pushed, failed, (pushed + failed) / elapsed if elapsed else 0))
+        elapsed = time.time() - started
+        self.stdout.write('Check ins pushed: %s, failed: %s, time: %.2fs, %.1f requests/s' %
+                          (pushed, failed, elapsed, (pushed + failed) / elapsed if elapsed else 0))
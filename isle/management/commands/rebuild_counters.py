@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from isle.counters import rebuild_counters
+
+
+class Command(BaseCommand):
+    help = 'Пересчитать счетчики записей и материалов эвентов и команд, а также сводку материалов'
+
+    def handle(self, *args, **options):
+        rebuild_counters()
@@ -0,0 +1,27 @@
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from isle.utils import get_active_events, update_check_ins_for_events
+
+
+class Command(BaseCommand):
+    help = 'Обновить из ILE чекины всех доступных для оцифровки эвентов за несколько дней'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help='Первый день в формате YYYY-MM-DD, по умолчанию сегодня')
+        parser.add_argument('--days', type=int, default=1, help='Количество дней, по умолчанию 1')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Количество одновременных запросов в ILE, по умолчанию CHECK_INS_REFRESH_WORKERS')
+
+    def handle(self, *args, **options):
+        if options['date']:
+            try:
+                date_from = datetime.strptime(options['date'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('Date should be in YYYY-MM-DD format')
+        else:
+            date_from = timezone.localtime(timezone.now()).date()
+        date_to = date_from + timezone.timedelta(days=max(options['days'], 1) - 1)
+        events = get_active_events(date_from, date_to).only('id', 'uid', 'ile_id', 'ext_id')
+        updated = update_check_ins_for_events(events, workers=options['workers'])
+        self.stdout.write('Check ins updated for %s of %s events' % (updated, len(events)))
@@ -0,0 +1,22 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from isle.jobs import run_pending_jobs
+
+
+class Command(BaseCommand):
+    help = 'Фоновый обработчик задач на обновление данных из ILE, поставленных из интерфейса'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', default=False,
+                            help='Выполнить ожидающие задачи и завершиться')
+
+    def handle(self, *args, **options):
+        interval = getattr(settings, 'SYNC_JOBS_POLL_INTERVAL', 2)
+        while True:
+            close_old_connections()
+            run_pending_jobs()
+            if options['once']:
+                break
+            time.sleep(interval)
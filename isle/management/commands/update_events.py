@@ -1,14 +1,49 @@
+import logging
+from datetime import timedelta
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.utils import timezone
+from isle.models import SyncRun
+from isle.sync import SyncStats
+from isle.telemetry import SyncTelemetry
 from isle.utils import refresh_events_data, update_events_traces, refresh_events_data_v2
 
 
 class Command(BaseCommand):
     help = 'Обновить список эвентов и ассайнментов из ILE, а также трейсы'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--stats', action='store_true', default=False,
+                            help='Вывести количество добавленных/измененных/неизмененных записей, время работы и '
+                                 'замеры по фазам')
+        parser.add_argument('--full', action='store_true', default=False,
+                            help='Полное постраничное обновление вместо обновления измененных активностей '
+                                 '(если не используется снэпшот)')
+        parser.add_argument('--trace-memory', action='store_true', default=False,
+                            help='Замерять пиковую память по фазам синхронизации (замедляет работу)')
+
     def handle(self, *args, **options):
-        if settings.USE_ILE_SNAPSHOT:
-            refresh_events_data(force=True, refresh_participants=True)
-        else:
-            refresh_events_data_v2()
-        update_events_traces()
+        stats = SyncStats()
+        telemetry = SyncTelemetry(trace_memory=options['trace_memory'] or
+                                  getattr(settings, 'SYNC_TELEMETRY_TRACE_MEMORY', False))
+        started_on = timezone.now()
+        with telemetry.collect():
+            if settings.USE_ILE_SNAPSHOT:
+                success = refresh_events_data(force=True, refresh_participants=True, stats=stats)
+            else:
+                success = refresh_events_data_v2(full=options['full'])
+            update_events_traces(stats=stats)
+        stats.finish()
+        success = bool(success)
+        summary = telemetry.summary()
+        # одна строка json с замерами по фазам для разбора логов
+        report = telemetry.to_json(command='update_events', success=success, stats=stats.counters)
+        logging.info(report)
+        if getattr(settings, 'SAVE_SYNC_RUNS', True):
+            SyncRun.objects.create(command='update_events', started_on=started_on, duration=summary['duration'],
+                                   success=success, stats=dict(stats.counters), phases=summary['phases'])
+            expired = started_on - timedelta(days=getattr(settings, 'SYNC_RUNS_KEEP_DAYS', 30))
+            SyncRun.objects.filter(command='update_events', started_on__lt=expired).delete()
+        if options['stats']:
+            self.stdout.write(report)
+            self.stdout.write(str(stats))
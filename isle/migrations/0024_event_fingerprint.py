@@ -0,0 +1,18 @@
+# Generated by Django 2.0.7 on 2026-10-18 05:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('isle', '0023_merge_20180719_2200'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='fingerprint',
+            field=models.CharField(blank=True, default='', max_length=40, verbose_name='Хеш данных ILE на момент последней синхронизации'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.0.7 on 2026-10-18 05:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('isle', '0024_event_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(blank=True, db_index=True, default='', max_length=255, verbose_name='Область')),
+                ('pending_scope', models.CharField(blank=True, editable=False, max_length=255, null=True, unique=True)),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')], db_index=True, default='pending', max_length=20, verbose_name='Статус')),
+                ('created_on', models.DateTimeField(auto_now_add=True, verbose_name='Создана')),
+                ('started_on', models.DateTimeField(blank=True, null=True, verbose_name='Начата')),
+                ('finished_on', models.DateTimeField(blank=True, null=True, verbose_name='Завершена')),
+            ],
+            options={
+                'verbose_name': 'Задача обновления',
+                'verbose_name_plural': 'Задачи обновления',
+            },
+        ),
+    ]
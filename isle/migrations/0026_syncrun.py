@@ -0,0 +1,31 @@
+# Generated by Django 2.0.7 on 2026-10-18 05:20
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('isle', '0025_syncjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('command', models.CharField(max_length=50, verbose_name='Команда')),
+                ('started_on', models.DateTimeField(verbose_name='Начало')),
+                ('duration', models.FloatField(verbose_name='Длительность, с')),
+                ('success', models.BooleanField(default=True, verbose_name='Успешно')),
+                ('stats', jsonfield.fields.JSONField(blank=True, default=dict, verbose_name='Изменения')),
+                ('phases', jsonfield.fields.JSONField(blank=True, default=dict, verbose_name='Фазы')),
+            ],
+            options={
+                'verbose_name': 'Запуск синхронизации',
+                'verbose_name_plural': 'Запуски синхронизации',
+                'ordering': ['-started_on'],
+            },
+        ),
+    ]
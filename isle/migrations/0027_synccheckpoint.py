@@ -0,0 +1,25 @@
+# Generated by Django 2.0.7 on 2026-10-18 05:21
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('isle', '0026_syncrun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('page', models.PositiveIntegerField(default=0)),
+                ('fetched_uids', jsonfield.fields.JSONField(blank=True, default=list)),
+                ('started_on', models.DateTimeField()),
+                ('updated_on', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
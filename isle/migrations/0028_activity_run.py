@@ -0,0 +1,55 @@
+# Generated by Django 2.0.7 on 2026-10-18 05:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('isle', '0027_synccheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Activity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ext_id', models.PositiveIntegerField(unique=True, verbose_name='id в LABS')),
+                ('ile_id', models.PositiveIntegerField(blank=True, default=None, null=True, verbose_name='id в ILE')),
+                ('title', models.CharField(default='', max_length=1000, verbose_name='Название')),
+                ('data', jsonfield.fields.JSONField()),
+                ('fingerprint', models.CharField(blank=True, default='', max_length=40, verbose_name='Хеш данных ILE на момент последней синхронизации')),
+            ],
+            options={
+                'verbose_name': 'Активность',
+                'verbose_name_plural': 'Активности',
+            },
+        ),
+        migrations.CreateModel(
+            name='Run',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ext_id', models.PositiveIntegerField(unique=True, verbose_name='id в LABS')),
+                ('ile_id', models.PositiveIntegerField(blank=True, default=None, null=True, verbose_name='id в ILE')),
+                ('data', jsonfield.fields.JSONField()),
+                ('fingerprint', models.CharField(blank=True, default='', max_length=40, verbose_name='Хеш данных ILE на момент последней синхронизации')),
+                ('activity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='isle.Activity', verbose_name='Активность')),
+            ],
+            options={
+                'verbose_name': 'Прогон',
+                'verbose_name_plural': 'Прогоны',
+            },
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='activity',
+            field=models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, to='isle.Activity', verbose_name='Активность'),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='run',
+            field=models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, to='isle.Run', verbose_name='Прогон'),
+        ),
+    ]
@@ -0,0 +1,68 @@
+from django.db import migrations
+
+BATCH_SIZE = 500
+
+
+def chunks(items, size=BATCH_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def move_to_tables(apps, schema_editor):
+    """
+    перенос активностей и прогонов из данных эвентов в отдельные таблицы. Хеш у них не заполняется,
+    поэтому при следующей синхронизации они будут перезаписаны
+    """
+    Event = apps.get_model('isle', 'Event')
+    Activity = apps.get_model('isle', 'Activity')
+    Run = apps.get_model('isle', 'Run')
+    activity_ids = dict(Activity.objects.values_list('ext_id', 'id'))
+    run_ids = dict(Run.objects.values_list('ext_id', 'id'))
+    for batch in chunks(Event.objects.order_by('id').values_list('id', flat=True)):
+        for event in Event.objects.filter(id__in=batch):
+            data = event.data if isinstance(event.data, dict) else {}
+            activity = data.get('activity') or {}
+            run = data.get('run') or {}
+            activity_ext_id, run_ext_id = activity.get('ext_id'), run.get('ext_id')
+            if activity_ext_id is None:
+                continue
+            activity_ext_id = int(activity_ext_id)
+            if activity_ext_id not in activity_ids:
+                activity_ids[activity_ext_id] = Activity.objects.create(
+                    ext_id=activity_ext_id, ile_id=activity.get('id'), title=activity.get('title') or '',
+                    data=activity).id
+            event.activity_id = activity_ids[activity_ext_id]
+            data.pop('activity')
+            if run_ext_id is not None:
+                run_ext_id = int(run_ext_id)
+                if run_ext_id not in run_ids:
+                    run_ids[run_ext_id] = Run.objects.create(ext_id=run_ext_id, ile_id=run.get('id'),
+                                                             activity_id=event.activity_id, data=run).id
+                event.run_id = run_ids[run_ext_id]
+                data.pop('run')
+            event.data = data
+            event.save(update_fields=['data', 'activity', 'run'])
+
+
+def move_to_events(apps, schema_editor):
+    Event = apps.get_model('isle', 'Event')
+    for batch in chunks(Event.objects.exclude(activity=None).order_by('id').values_list('id', flat=True)):
+        for event in Event.objects.filter(id__in=batch).select_related('activity', 'run'):
+            data = event.data if isinstance(event.data, dict) else {}
+            data['activity'] = event.activity.data
+            if event.run is not None:
+                data['run'] = event.run.data
+            event.data = data
+            event.save(update_fields=['data'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('isle', '0028_activity_run'),
+    ]
+
+    operations = [
+        migrations.RunPython(move_to_tables, move_to_events),
+    ]
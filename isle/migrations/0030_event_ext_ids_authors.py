@@ -0,0 +1,29 @@
+# Generated by Django 2.0.7 on 2026-10-18 05:29
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('isle', '0029_event_activity_run_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='activity_ext_id',
+            field=models.PositiveIntegerField(blank=True, db_index=True, default=None, null=True, verbose_name='id активности в LABS'),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='authors',
+            field=jsonfield.fields.JSONField(blank=True, default=list, verbose_name='Авторы активности'),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='run_ext_id',
+            field=models.PositiveIntegerField(blank=True, db_index=True, default=None, null=True, verbose_name='id прогона в LABS'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+from django.db import migrations
+
+BATCH_SIZE = 500
+
+
+def chunks(items, size=BATCH_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def get_ext_id(data):
+    ext_id = (data or {}).get('ext_id')
+    return int(ext_id) if ext_id is not None else None
+
+
+def fill_columns(apps, schema_editor):
+    """
+    заполнение id прогона и активности в LABS и авторов эвентов из их активностей и прогонов,
+    а если их нет - из данных самих эвентов
+    """
+    Event = apps.get_model('isle', 'Event')
+    for batch in chunks(Event.objects.order_by('id').values_list('id', flat=True)):
+        for event in Event.objects.filter(id__in=batch).select_related('activity', 'run'):
+            data = event.data if isinstance(event.data, dict) else {}
+            activity = event.activity.data if event.activity is not None else data.get('activity')
+            run = event.run.data if event.run is not None else data.get('run')
+            event.activity_ext_id = get_ext_id(activity)
+            event.run_ext_id = get_ext_id(run)
+            event.authors = [(i.get('title') or '').strip() for i in (activity or {}).get('authors') or []]
+            event.save(update_fields=['activity_ext_id', 'run_ext_id', 'authors'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('isle', '0030_event_ext_ids_authors'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_columns, migrations.RunPython.noop),
+    ]
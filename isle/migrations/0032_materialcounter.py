@@ -0,0 +1,31 @@
+# Generated by Django 2.0.7 on 2026-10-18 05:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('isle', '0031_fill_event_ext_ids_authors'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MaterialCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_user', models.BooleanField(default=False, verbose_name='Загружены пользователями')),
+                ('num', models.PositiveIntegerField(default=0, verbose_name='Количество')),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='isle.Event', verbose_name='Событие')),
+            ],
+            options={
+                'verbose_name': 'Счетчик материалов',
+                'verbose_name_plural': 'Счетчики материалов',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='materialcounter',
+            unique_together={('event', 'is_user')},
+        ),
+    ]
@@ -0,0 +1,37 @@
+from collections import Counter
+from django.db import migrations
+from django.db.models import Count
+
+
+def fill_counters(apps, schema_editor):
+    """
+    подсчет материалов по эвентам так же, как это делалось в сводке на главной странице
+    """
+    User = apps.get_model('isle', 'User')
+    MaterialCounter = apps.get_model('isle', 'MaterialCounter')
+    assistants = User.objects.filter(is_assistant=True).values_list('id', flat=True)
+    counts = Counter()
+    for name in ('EventMaterial', 'EventTeamMaterial', 'EventOnlyMaterial'):
+        model = apps.get_model('isle', name)
+        for event_id, num in model.objects.values_list('event_id').annotate(num=Count('id')):
+            counts[(event_id, False)] += num
+        if name == 'EventOnlyMaterial':
+            continue
+        user_materials = model.objects.exclude(initiator__isnull=True).exclude(initiator__in=assistants)
+        for event_id, num in user_materials.values_list('event_id').annotate(num=Count('id')):
+            counts[(event_id, True)] += num
+            counts[(event_id, False)] -= num
+    MaterialCounter.objects.all().delete()
+    MaterialCounter.objects.bulk_create([MaterialCounter(event_id=event_id, is_user=is_user, num=num)
+                                         for (event_id, is_user), num in counts.items() if num], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('isle', '0032_materialcounter'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.0.7 on 2026-10-18 05:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('isle', '0033_fill_materialcounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='entry_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Количество записей'),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='event_only_material_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Количество материалов мероприятия'),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='trace_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Количество материалов'),
+        ),
+        migrations.AddField(
+            model_name='team',
+            name='traces_number',
+            field=models.PositiveIntegerField(default=0, verbose_name='Количество материалов'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+from django.db import migrations
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def count_subquery(queryset, field):
+    queryset = queryset.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(num=Count('pk'))
+    return Coalesce(Subquery(queryset.values('num')), Value(0))
+
+
+def fill_counters(apps, schema_editor):
+    Event = apps.get_model('isle', 'Event')
+    Team = apps.get_model('isle', 'Team')
+    EventEntry = apps.get_model('isle', 'EventEntry')
+    EventMaterial = apps.get_model('isle', 'EventMaterial')
+    EventTeamMaterial = apps.get_model('isle', 'EventTeamMaterial')
+    EventOnlyMaterial = apps.get_model('isle', 'EventOnlyMaterial')
+    Event.objects.update(
+        entry_count=count_subquery(EventEntry.objects.filter(deleted=False), 'event'),
+        trace_count=(count_subquery(EventMaterial.objects.all(), 'event') +
+                     count_subquery(EventTeamMaterial.objects.all(), 'event') +
+                     count_subquery(EventOnlyMaterial.objects.all(), 'event')),
+        event_only_material_count=count_subquery(EventOnlyMaterial.objects.all(), 'event'),
+    )
+    Team.objects.update(traces_number=count_subquery(EventTeamMaterial.objects.all(), 'team'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('isle', '0034_event_team_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
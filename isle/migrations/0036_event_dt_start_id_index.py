@@ -0,0 +1,17 @@
+# Generated by Django 2.0.7 on 2026-10-18 05:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('isle', '0035_fill_event_team_counters'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['dt_start', 'id'], name='isle_event_dt_star_e776c4_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.0.7 on 2026-10-18 06:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('isle', '0036_event_dt_start_id_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncLock',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('token', models.CharField(blank=True, default='', max_length=32)),
+                ('expires_on', models.DateTimeField()),
+                ('result', models.NullBooleanField()),
+            ],
+        ),
+    ]
@@ -3,7 +3,6 @@ import urllib
 from django.contrib.auth.models import AbstractUser
 from django.db import models
 from django.utils import timezone
-from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
 from jsonfield import JSONField
 
@@ -43,6 +42,44 @@ class EventType(models.Model):
         return self.title
 
 
+class Activity(models.Model):
+    """
+    Активность ILE. Данные активности хранятся здесь один раз, а не в каждом ее эвенте
+    """
+    ext_id = models.PositiveIntegerField(unique=True, verbose_name='id в LABS')
+    ile_id = models.PositiveIntegerField(null=True, blank=True, default=None, verbose_name='id в ILE')
+    title = models.CharField(max_length=1000, default='', verbose_name='Название')
+    data = JSONField()
+    fingerprint = models.CharField(max_length=40, blank=True, default='',
+                                   verbose_name='Хеш данных ILE на момент последней синхронизации')
+
+    class Meta:
+        verbose_name = 'Активность'
+        verbose_name_plural = 'Активности'
+
+    def __str__(self):
+        return self.title or str(self.ext_id)
+
+
+class Run(models.Model):
+    """
+    Прогон активности ILE
+    """
+    ext_id = models.PositiveIntegerField(unique=True, verbose_name='id в LABS')
+    ile_id = models.PositiveIntegerField(null=True, blank=True, default=None, verbose_name='id в ILE')
+    activity = models.ForeignKey(Activity, on_delete=models.CASCADE, verbose_name='Активность')
+    data = JSONField()
+    fingerprint = models.CharField(max_length=40, blank=True, default='',
+                                   verbose_name='Хеш данных ILE на момент последней синхронизации')
+
+    class Meta:
+        verbose_name = 'Прогон'
+        verbose_name_plural = 'Прогоны'
+
+    def __str__(self):
+        return '%s (%s)' % (self.activity, self.ext_id)
+
+
 class Event(models.Model):
     uid = models.CharField(max_length=255, unique=True, verbose_name=_(u'UID события'))
     data = JSONField()
@@ -54,10 +91,29 @@ class Event(models.Model):
                                    blank=True, null=True, default=None)
     ile_id = models.PositiveIntegerField(default=None, verbose_name='id в ILE')
     ext_id = models.PositiveIntegerField(default=None, verbose_name='id в LABS')
+    fingerprint = models.CharField(max_length=40, blank=True, default='',
+                                   verbose_name='Хеш данных ILE на момент последней синхронизации')
+    activity = models.ForeignKey(Activity, on_delete=models.SET_NULL, verbose_name='Активность',
+                                 blank=True, null=True, default=None)
+    run = models.ForeignKey(Run, on_delete=models.SET_NULL, verbose_name='Прогон',
+                            blank=True, null=True, default=None)
+    # копии полей прогона и активности для списков эвентов, которые не загружают data
+    run_ext_id = models.PositiveIntegerField(null=True, blank=True, default=None, db_index=True,
+                                             verbose_name='id прогона в LABS')
+    activity_ext_id = models.PositiveIntegerField(null=True, blank=True, default=None, db_index=True,
+                                                  verbose_name='id активности в LABS')
+    authors = JSONField(blank=True, default=list, verbose_name='Авторы активности')
+    # счетчики, поддерживаемые при изменении записей и материалов (пересчет - команда rebuild_counters)
+    entry_count = models.PositiveIntegerField(default=0, verbose_name='Количество записей')
+    trace_count = models.PositiveIntegerField(default=0, verbose_name='Количество материалов')
+    event_only_material_count = models.PositiveIntegerField(default=0, verbose_name='Количество материалов '
+                                                                                     'мероприятия')
 
     class Meta:
         verbose_name = _(u'Событие')
         verbose_name_plural = _(u'События')
+        # для постраничного списка эвентов (см. Index.get_page)
+        indexes = [models.Index(fields=['dt_start', 'id'])]
 
     def __str__(self):
         fmt = '%H:%M %d.%m.%Y'
@@ -79,23 +135,8 @@ class Event(models.Model):
             return sorted(traces, key=lambda x: order.get(x.name, 0))
         return Trace.objects.none()
 
-    @property
-    def entry_count(self):
-        return EventEntry.objects.filter(event=self).count()
-
-    @property
-    def trace_count(self):
-        return EventMaterial.objects.filter(event=self).count() + EventTeamMaterial.objects.filter(event=self).count() + EventOnlyMaterial.objects.filter(event=self).count()
-
-    @cached_property
-    def event_only_material_count(self):
-        return EventOnlyMaterial.objects.filter(event=self).count()
-
     def get_authors(self):
-        if self.data and isinstance(self.data, dict):
-            authors = (self.data.get('activity') or {}).get('authors') or []
-            return [(i.get('title') or '').strip() for i in authors]
-        return []
+        return self.authors or []
 
 
 class Trace(models.Model):
@@ -145,7 +186,11 @@ class EventEntry(models.Model):
         return '%s - %s' % (self.event, self.user)
 
     def approved(self):
-        return self.is_active or Attendance.objects.filter(user=self.user, event=self.event, is_confirmed=True)
+        # attend может быть уже посчитан в запросе (см. get_event_roster)
+        attend = getattr(self, 'attend', None)
+        if attend is None:
+            attend = Attendance.objects.filter(user_id=self.user_id, event_id=self.event_id, is_confirmed=True).exists()
+        return self.is_active or attend
 
 
 class Attendance(models.Model):
@@ -214,15 +259,12 @@ class Team(models.Model):
     name = models.CharField(max_length=500, verbose_name='Название команды')
     creator = models.ForeignKey(User, on_delete=models.CASCADE, null=True, default=None, related_name='team_creator')
     confirmed = models.BooleanField(default=True)
+    traces_number = models.PositiveIntegerField(default=0, verbose_name='Количество материалов')
 
     @property
     def team_name(self):
         return 'team_{}'.format(self.id)
 
-    @property
-    def traces_number(self):
-        return EventTeamMaterial.objects.filter(team=self).count()
-
     class Meta:
         verbose_name = 'Команда'
         verbose_name_plural = 'Команды'
@@ -249,3 +291,109 @@ class EventOnlyMaterial(AbstractMaterial):
     class Meta:
         verbose_name = _(u'Материал мероприятия')
         verbose_name_plural = _(u'Материалы мероприятий')
+
+
+class MaterialCounter(models.Model):
+    """
+    Количество материалов эвента всех видов для сводки на главной странице ассистента, отдельно
+    для загруженных пользователями (is_user=True) и остальных. Обновляется сигналами при создании
+    и удалении материалов (isle/signals.py)
+    """
+    event = models.ForeignKey(Event, on_delete=models.CASCADE, verbose_name='Событие')
+    is_user = models.BooleanField(default=False, verbose_name='Загружены пользователями')
+    num = models.PositiveIntegerField(default=0, verbose_name='Количество')
+
+    class Meta:
+        verbose_name = 'Счетчик материалов'
+        verbose_name_plural = 'Счетчики материалов'
+        unique_together = ('event', 'is_user')
+
+    def __str__(self):
+        return '%s %s: %s' % (self.event_id, self.is_user, self.num)
+
+
+class SyncJob(models.Model):
+    """
+    Задача на обновление данных из ILE, выполняемая фоновым обработчиком (команда run_sync_jobs).
+    scope - область обновления: пустая строка для всех эвентов или uid эвента
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUSES = (
+        (STATUS_PENDING, STATUS_PENDING),
+        (STATUS_RUNNING, STATUS_RUNNING),
+        (STATUS_DONE, STATUS_DONE),
+        (STATUS_FAILED, STATUS_FAILED),
+    )
+
+    scope = models.CharField(max_length=255, blank=True, default='', db_index=True, verbose_name='Область')
+    # область ожидающей задачи (у остальных задач NULL): уникальность не дает создать вторую ожидающую
+    # задачу на ту же область одновременными запросами
+    pending_scope = models.CharField(max_length=255, null=True, blank=True, unique=True, editable=False)
+    status = models.CharField(max_length=20, choices=STATUSES, default=STATUS_PENDING, db_index=True,
+                              verbose_name='Статус')
+    created_on = models.DateTimeField(auto_now_add=True, verbose_name='Создана')
+    started_on = models.DateTimeField(null=True, blank=True, verbose_name='Начата')
+    finished_on = models.DateTimeField(null=True, blank=True, verbose_name='Завершена')
+
+    class Meta:
+        verbose_name = 'Задача обновления'
+        verbose_name_plural = 'Задачи обновления'
+
+    def __str__(self):
+        return '%s %s' % (self.scope or 'all', self.status)
+
+    @property
+    def is_finished(self):
+        return self.status in (self.STATUS_DONE, self.STATUS_FAILED)
+
+
+class SyncRun(models.Model):
+    """
+    Запуск синхронизации с замерами по фазам (см. isle.telemetry)
+    """
+    command = models.CharField(max_length=50, verbose_name='Команда')
+    started_on = models.DateTimeField(verbose_name='Начало')
+    duration = models.FloatField(verbose_name='Длительность, с')
+    success = models.BooleanField(default=True, verbose_name='Успешно')
+    stats = JSONField(blank=True, default=dict, verbose_name='Изменения')
+    phases = JSONField(blank=True, default=dict, verbose_name='Фазы')
+
+    class Meta:
+        verbose_name = 'Запуск синхронизации'
+        verbose_name_plural = 'Запуски синхронизации'
+        ordering = ['-started_on']
+
+    def __str__(self):
+        return '%s %s' % (self.command, self.started_on)
+
+
+class SyncCheckpoint(models.Model):
+    """
+    Состояние незавершенной постраничной синхронизации, с которого ее можно продолжить: последняя
+    обработанная страница и uid эвентов, полученных с начала синхронизации
+    """
+    name = models.CharField(max_length=50, unique=True)
+    page = models.PositiveIntegerField(default=0)
+    fetched_uids = JSONField(blank=True, default=list)
+    started_on = models.DateTimeField()
+    updated_on = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '%s: %s' % (self.name, self.page)
+
+
+class SyncLock(models.Model):
+    """
+    Блокировка между процессами (см. isle.locks.DbLock): token владельца (пустой у свободной блокировки),
+    срок, до которого она выдана, и результат последнего освободившего ее владельца
+    """
+    name = models.CharField(max_length=50, unique=True)
+    token = models.CharField(max_length=32, blank=True, default='')
+    expires_on = models.DateTimeField()
+    result = models.NullBooleanField()
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,42 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from isle.counters import MATERIAL_MODELS, update_material_counters
+from isle.db import update_entry_counts
+from isle.models import EventEntry, EventType, Trace
+from isle.traces import invalidate_traces
+
+
+def material_created(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        update_material_counters(instance, 1)
+
+
+def material_deleted(sender, instance, **kwargs):
+    update_material_counters(instance, -1)
+
+
+def entry_saved(sender, instance, raw=False, **kwargs):
+    # пачки записей при синхронизации создаются в обход сигналов, там счетчик пересчитывается отдельно.
+    # На удаление записей сигнал не вешается, чтобы не замедлять каскадное удаление эвентов
+    if not raw:
+        update_entry_counts([instance.event_id])
+
+
+def traces_changed(sender, **kwargs):
+    # сохранение типа мероприятия (порядок результатов в trace_data), результатов и их связей с эвентами
+    # из админки. sync_traces меняет их пачками в обход сигналов и сбрасывает кеш сам
+    invalidate_traces()
+
+
+def trace_events_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_traces()
+
+
+for model in MATERIAL_MODELS:
+    post_save.connect(material_created, sender=model, dispatch_uid='material_created_%s' % model.__name__)
+    post_delete.connect(material_deleted, sender=model, dispatch_uid='material_deleted_%s' % model.__name__)
+post_save.connect(entry_saved, sender=EventEntry, dispatch_uid='entry_saved')
+for model in (EventType, Trace):
+    post_save.connect(traces_changed, sender=model, dispatch_uid='traces_saved_%s' % model.__name__)
+    post_delete.connect(traces_changed, sender=model, dispatch_uid='traces_deleted_%s' % model.__name__)
+m2m_changed.connect(trace_events_changed, sender=Trace.events.through, dispatch_uid='trace_events_changed')
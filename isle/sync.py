@@ -0,0 +1,535 @@
+import hashlib
+import json
+import logging
+import time
+from collections import Counter, OrderedDict, defaultdict
+from datetime import datetime
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from isle.db import BATCH_SIZE, bulk_update, chunks, update_entry_counts
+from isle.models import Activity, Event, EventEntry, EventType, Run, Trace, User
+from isle.telemetry import phase
+from isle.traces import invalidate_traces
+
+# ключ кеша с данными эвента для индекса эвентов снэпшота
+EVENT_INDEX_CACHE_KEY = 'EVENT_INDEX_%s'
+
+ACTIVITY_EXCLUDE_KEYS = ['runs', 'activity_type', 'rates']
+RUN_EXCLUDE_KEYS = ['bets', 'assignments', 'events']
+EVENT_EXCLUDE_KEYS = ['check_ins', 'time_slot']
+
+
+def filter_dict(d, excl):
+    return {k: d.get(k) for k in d if k not in excl}
+
+
+def reconcile_event_entries(pairs, batch_size=BATCH_SIZE):
+    """
+    Создание недостающих записей на эвенты по парам (id эвента, id пользователя). Существующие пары,
+    включая удаленные записи, загружаются одним запросом на пачку эвентов, а недостающие создаются
+    через bulk_create. Возвращает список созданных пар
+    """
+    pairs = set(pairs)
+    existing = set()
+    for batch in chunks({event_id for event_id, _ in pairs}, batch_size):
+        existing.update(EventEntry.all_objects.filter(event_id__in=batch).values_list('event_id', 'user_id'))
+    missing = sorted(pairs - existing)
+    EventEntry.all_objects.bulk_create([EventEntry(event_id=event_id, user_id=user_id)
+                                        for event_id, user_id in missing], batch_size=batch_size)
+    update_entry_counts({event_id for event_id, _ in missing}, batch_size)
+    return missing
+
+
+def sync_traces(traces, stats=None, batch_size=BATCH_SIZE):
+    """
+    Синхронизация результатов с данными LABS. Результаты создаются и обновляются пачками, а связи
+    с эвентами сравниваются с содержимым промежуточной таблицы целиком: недостающие пары
+    добавляются через bulk_create, лишние удаляются пачками. Результаты, которых нет в данных,
+    не затрагиваются
+    """
+    stats = stats if stats is not None else SyncStats()
+    data = OrderedDict((int(trace['id']), trace) for trace in traces)
+    event_ids = dict(Event.objects.values_list('uid', 'id'))
+    existing = {}
+    for batch in chunks(data, batch_size):
+        for t in Trace.objects.filter(ext_id__in=batch).order_by('-id'):
+            existing[t.ext_id] = t
+    to_create, to_update = [], []
+    for ext_id, trace in data.items():
+        values = {'trace_type': trace['title'], 'name': trace['description']}
+        t = existing.get(ext_id)
+        if t is None:
+            to_create.append(Trace(ext_id=ext_id, **values))
+        elif any(getattr(t, k) != v for k, v in values.items()):
+            for k, v in values.items():
+                setattr(t, k, v)
+            to_update.append(t)
+    through = Trace.events.through
+    with transaction.atomic():
+        if to_create:
+            Trace.objects.bulk_create(to_create, batch_size=batch_size)
+            for batch in chunks([t.ext_id for t in to_create], batch_size):
+                for t in Trace.objects.filter(ext_id__in=batch).order_by('-id'):
+                    existing[t.ext_id] = t
+            stats.add('traces_inserted', len(to_create))
+        if to_update:
+            bulk_update(to_update, ['trace_type', 'name'], batch_size=batch_size)
+            stats.add('traces_updated', len(to_update))
+        wanted = set()
+        for ext_id, trace in data.items():
+            trace_id = existing[ext_id].id
+            wanted.update((trace_id, event_ids[uid]) for uid in trace.get('events') or [] if uid in event_ids)
+        current = {}
+        for batch in chunks([t.id for t in existing.values()], batch_size):
+            for pk, trace_id, event_id in through.objects.filter(trace_id__in=batch).values_list(
+                    'id', 'trace_id', 'event_id'):
+                current[(trace_id, event_id)] = pk
+        to_add = sorted(wanted - set(current))
+        to_delete = [pk for pair, pk in current.items() if pair not in wanted]
+        through.objects.bulk_create([through(trace_id=trace_id, event_id=event_id) for trace_id, event_id in to_add],
+                                    batch_size=batch_size)
+        for batch in chunks(to_delete, batch_size):
+            through.objects.filter(id__in=batch).delete()
+    if to_create or to_update or to_add or to_delete:
+        invalidate_traces()
+    stats.add('trace_events_added', len(to_add))
+    stats.add('trace_events_removed', len(to_delete))
+    return stats
+
+
+def get_index_cache():
+    """
+    кеш индекса эвентов или None, если для индекса не выделен отдельный кеш: в кеше default записи
+    индекса вытесняли бы блокировки, токен и валидаторы
+    """
+    alias = getattr(settings, 'EVENTS_INDEX_CACHE', 'events_index')
+    if alias == 'default' or alias not in settings.CACHES:
+        return None
+    return caches[alias]
+
+
+def get_indexed_activities(uids):
+    """
+    Активности из индекса эвентов снэпшота для обновления отдельных эвентов: в каждой активности
+    только прогон и эвент с нужным uid. Если какого-то эвента в индексе нет, возвращается None
+    """
+    cache = get_index_cache()
+    if cache is None:
+        return None
+    keys = [EVENT_INDEX_CACHE_KEY % uid for uid in uids]
+    found = cache.get_many(keys)
+    if len(found) < len(keys):
+        return None
+    return [dict(activity, runs=[dict(run, events=[event])]) for activity, run, event in (found[k] for k in keys)]
+
+
+class SyncStats:
+    """
+    счетчики записей, затронутых синхронизацией, и время ее работы
+    """
+    def __init__(self):
+        self.counters = Counter()
+        self.started = time.time()
+        self.finished = None
+
+    def add(self, key, num=1):
+        self.counters[key] += num
+
+    def finish(self):
+        self.finished = time.time()
+
+    @property
+    def duration(self):
+        return (self.finished or time.time()) - self.started
+
+    def __getitem__(self, key):
+        return self.counters[key]
+
+    def __str__(self):
+        items = ', '.join('%s: %s' % i for i in sorted(self.counters.items()))
+        return '%s; time: %.2fs' % (items or 'no changes', self.duration)
+
+
+def get_fingerprint(payload):
+    """
+    устойчивый хеш json-сериализуемых данных
+    """
+    data = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def get_ext_id(data):
+    """
+    внешний id (id в LABS) активности, прогона или эвента из данных ILE
+    """
+    ext_id = data.get('ext_id')
+    return int(ext_id) if ext_id is not None else None
+
+
+def get_authors(activity_json):
+    return [(i.get('title') or '').strip() for i in activity_json.get('authors') or []]
+
+
+def get_event_data(event_json, run_json, activity_json, run_ext_id=None, activity_ext_id=None):
+    """
+    данные эвента для Event.data: активность и прогон хранятся в своих таблицах и копируются
+    в эвент, только если у них нет внешнего id
+    """
+    data = {'event': event_json}
+    if run_ext_id is None:
+        data['run'] = run_json
+    if activity_ext_id is None:
+        data['activity'] = activity_json
+    return data
+
+
+class ActivityCatalog:
+    """
+    Активности и прогоны ILE, вынесенные из данных эвентов. Они передаются через add_activity/add_run,
+    а в flush пачками записываются новые и изменившиеся (по хешу данных) записи. flush надо вызвать
+    до записи эвентов, ссылающихся на них, после чего их id доступны через get_activity_id/get_run_id
+    """
+    def __init__(self, stats=None, batch_size=BATCH_SIZE):
+        self.stats = stats if stats is not None else SyncStats()
+        self.batch_size = batch_size
+        # {ext_id: (id, fingerprint)} для уже записанных в базу активностей и прогонов
+        self.activities = {}
+        self.runs = {}
+        self.pending_activities = OrderedDict()
+        self.pending_runs = OrderedDict()
+
+    def add_activity(self, activity_json):
+        """
+        возвращает внешний id активности или None, если его нет и активность не сохраняется
+        """
+        ext_id = get_ext_id(activity_json)
+        if ext_id is None:
+            return None
+        self.pending_activities[ext_id] = {
+            'ile_id': activity_json.get('id'),
+            'title': activity_json.get('title') or '',
+            'data': activity_json,
+        }
+        self.flush_if_full()
+        return ext_id
+
+    def add_run(self, run_json, activity_ext_id):
+        """
+        возвращает внешний id прогона или None, если прогон не сохраняется
+        """
+        ext_id = get_ext_id(run_json)
+        if ext_id is None or activity_ext_id is None:
+            return None
+        # до записи активностей вместо id активности хранится ее внешний id
+        self.pending_runs[ext_id] = {'ile_id': run_json.get('id'), 'activity_id': activity_ext_id,
+                                     'data': run_json}
+        self.flush_if_full()
+        return ext_id
+
+    def get_activity_id(self, ext_id):
+        return self.activities[ext_id][0] if ext_id in self.activities else None
+
+    def get_run_id(self, ext_id):
+        return self.runs[ext_id][0] if ext_id in self.runs else None
+
+    def flush_if_full(self):
+        if max(len(self.pending_activities), len(self.pending_runs)) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        pending_activities, self.pending_activities = self.pending_activities, OrderedDict()
+        pending_runs, self.pending_runs = self.pending_runs, OrderedDict()
+        with phase('activities'):
+            self.save(Activity, pending_activities, self.activities, 'activities')
+            for values in pending_runs.values():
+                values['activity_id'] = self.get_activity_id(values['activity_id'])
+            self.save(Run, pending_runs, self.runs, 'runs')
+
+    def save(self, model, pending, known, name):
+        """
+        запись в базу тех из pending ({ext_id: значения полей}), что отсутствуют в known или
+        отличаются от известных по хешу
+        """
+        if not pending:
+            return
+        for batch in chunks([ext_id for ext_id in pending if ext_id not in known], self.batch_size):
+            for ext_id, pk, fingerprint in model.objects.filter(ext_id__in=batch).values_list(
+                    'ext_id', 'id', 'fingerprint'):
+                known[ext_id] = (pk, fingerprint)
+        to_create, to_update = [], []
+        for ext_id, values in pending.items():
+            fingerprint = get_fingerprint(values)
+            if ext_id not in known:
+                to_create.append(model(ext_id=ext_id, fingerprint=fingerprint, **values))
+            elif known[ext_id][1] != fingerprint:
+                to_update.append(model(id=known[ext_id][0], ext_id=ext_id, fingerprint=fingerprint, **values))
+                known[ext_id] = (known[ext_id][0], fingerprint)
+        with transaction.atomic():
+            if to_create:
+                model.objects.bulk_create(to_create, batch_size=self.batch_size)
+                fingerprints = {obj.ext_id: obj.fingerprint for obj in to_create}
+                for batch in chunks(fingerprints, self.batch_size):
+                    for ext_id, pk in model.objects.filter(ext_id__in=batch).values_list('ext_id', 'id'):
+                        known[ext_id] = (pk, fingerprints[ext_id])
+                self.stats.add('%s_inserted' % name, len(to_create))
+            if to_update:
+                bulk_update(to_update, list(pending[to_update[0].ext_id]) + ['fingerprint'],
+                            batch_size=self.batch_size)
+                self.stats.add('%s_updated' % name, len(to_update))
+
+
+class EventsSync:
+    """
+    Синхронизация эвентов и записей на них с данными ILE. Текущее состояние эвентов загружается
+    из базы один раз, активности передаются по одной через add_activity, а в базу пачками пишутся
+    только изменившиеся эвенты. Изменения определяются по хешу данных эвента (fingerprint), в который
+    входят ссылки на активность и прогон, эвент, а также множества участников и чекинов. Сами
+    активности и прогоны пишутся через ActivityCatalog перед каждой пачкой эвентов. При build_index=True
+    для каждого эвента в кеш сохраняются его активность, прогон и сам эвент (см. get_indexed_activities).
+    После передачи всех активностей надо вызвать finish.
+    """
+    EVENT_FIELDS = ['is_active', 'ile_id', 'ext_id', 'data', 'dt_start', 'dt_end', 'title', 'event_type_id',
+                    'fingerprint', 'activity_id', 'run_id', 'run_ext_id', 'activity_ext_id', 'authors']
+
+    def __init__(self, refresh_participants=False, refresh_for_events=(), stats=None, batch_size=BATCH_SIZE,
+                 build_index=False):
+        self.refresh_participants = refresh_participants
+        self.index_cache = get_index_cache() if build_index else None
+        if build_index and self.index_cache is None:
+            logging.warning('EVENTS_INDEX_CACHE is not a separate cache alias, events index is not built')
+        self.build_index = self.index_cache is not None
+        self.index = {}
+        self.refresh_for_events = set(refresh_for_events)
+        self.stats = stats if stats is not None else SyncStats()
+        self.batch_size = batch_size
+        events = Event.objects.defer('data')
+        if self.refresh_for_events:
+            events = events.filter(uid__in=self.refresh_for_events)
+        self.existing = {e.uid: e for e in events}
+        self.existing_uids = set(self.existing)
+        self.fetched_events = set()
+        self.unti_id_to_user_id = dict(User.objects.values_list('unti_id', 'id'))
+        self.event_types = {t.ext_id: t for t in EventType.objects.all()}
+        self.checked_event_types = set()
+        self.pending = OrderedDict()
+        self.catalog = ActivityCatalog(self.stats, batch_size)
+        # {uid эвента: (внешний id активности, внешний id прогона)} для эвентов из pending
+        self.refs = {}
+
+    def add_activity(self, activity):
+        title = activity.get('title', '')
+        event_type = self.get_event_type(activity.get('activity_type'))
+        activity_json = filter_dict(activity, ACTIVITY_EXCLUDE_KEYS)
+        activity_index = filter_dict(activity, ['runs'])
+        activity_ext_id = self.catalog.add_activity(activity_json)
+        authors = get_authors(activity_json)
+        for run in activity.get('runs') or []:
+            run_json = filter_dict(run, RUN_EXCLUDE_KEYS)
+            run_ext_id = self.catalog.add_run(run_json, activity_ext_id)
+            run_index = filter_dict(run, ['events'])
+            participant_ids = []
+            for assignment in run.get('assignments') or []:
+                unti_id = (assignment.get('user') or {}).get('unti_id')
+                if unti_id:
+                    participant_ids.append(int(unti_id))
+            participants = sorted({self.unti_id_to_user_id.get(i) for i in participant_ids} - {None})
+            for event in run.get('events') or []:
+                uid = event['uuid']
+                if self.refresh_for_events and uid not in self.refresh_for_events:
+                    continue
+                if self.build_index:
+                    self.index[EVENT_INDEX_CACHE_KEY % uid] = (activity_index, run_index, event)
+                    if len(self.index) >= self.batch_size:
+                        self.flush_index()
+                checked = self.get_checked_users(event.get('check_ins') or [])
+                fingerprint = get_fingerprint({
+                    'activity': activity_json if activity_ext_id is None else activity_ext_id,
+                    'title': title,
+                    'authors': authors,
+                    'activity_type': activity.get('activity_type'),
+                    'run': run_json if run_ext_id is None else run_ext_id,
+                    'event': filter_dict(event, ['check_ins']),
+                    'participants': participants,
+                    'check_ins': sorted(checked),
+                })
+                existing = self.existing.get(uid)
+                # повторное вхождение эвента, уже ожидающего записи, не пропускается, иначе вместо данных
+                # последнего вхождения записались бы данные первого
+                if existing is not None and existing.fingerprint == fingerprint and uid not in self.pending:
+                    self.fetched_events.add(uid)
+                    self.stats.add('events_unchanged')
+                    continue
+                timeslot = event.get('time_slot')
+                dt_start, dt_end = datetime.now(), datetime.now()
+                if timeslot:
+                    dt_start = parse_datetime(timeslot['time_start']) or datetime.now()
+                    dt_end = parse_datetime(timeslot['time_end']) or datetime.now()
+                else:
+                    logging.warning('Event %s (%s) has no time slot' % (uid, title))
+                values = {
+                    'is_active': not event.get('is_delete'),
+                    'ile_id': event.get('id'),
+                    'ext_id': event.get('ext_id'),
+                    'data': get_event_data(filter_dict(event, EVENT_EXCLUDE_KEYS), run_json, activity_json,
+                                           run_ext_id, activity_ext_id),
+                    'dt_start': dt_start,
+                    'dt_end': dt_end,
+                    'title': title,
+                    'event_type_id': event_type and event_type.id,
+                    'run_ext_id': get_ext_id(run_json),
+                    'activity_ext_id': activity_ext_id,
+                    'authors': authors,
+                    # без обновления записей на эвент хеш не сохраняется, чтобы при следующей полной
+                    # синхронизации эвент не был пропущен
+                    'fingerprint': fingerprint if self.refresh_participants else '',
+                }
+                self.refs[uid] = (activity_ext_id, run_ext_id)
+                self.add_event(uid, values, participant_ids, checked)
+
+    def flush_index(self):
+        if self.index:
+            timeout = getattr(settings, 'EVENTS_INDEX_CACHE_TIME', 60 * 60 * 24)
+            self.index_cache.set_many(self.index, timeout=timeout)
+            self.index = {}
+
+    def get_event_type(self, activity_type):
+        if not activity_type or not activity_type.get('id'):
+            return None
+        ext_id = int(activity_type['id'])
+        event_type = self.event_types.get(ext_id)
+        if ext_id in self.checked_event_types:
+            return event_type
+        defaults = {'title': activity_type.get('title'), 'description': activity_type.get('description') or ''}
+        if event_type is None:
+            event_type = EventType.objects.create(ext_id=ext_id, **defaults)
+            self.event_types[ext_id] = event_type
+        elif any(getattr(event_type, k) != v for k, v in defaults.items()):
+            EventType.objects.filter(id=event_type.id).update(**defaults)
+            for k, v in defaults.items():
+                setattr(event_type, k, v)
+        self.checked_event_types.add(ext_id)
+        return event_type
+
+    def add_event(self, uid, values, participant_ids, checked):
+        self.fetched_events.add(uid)
+        if uid in self.pending:
+            # эвент встретился в данных повторно: записи создаются для обоих списков участников,
+            # а чекины берутся из последнего
+            participant_ids = self.pending[uid][1] + participant_ids
+        self.pending[uid] = (values, participant_ids, checked)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, OrderedDict()
+        self.catalog.flush()
+        to_create, to_update = [], []
+        for uid, (values, _, _) in pending.items():
+            activity_ext_id, run_ext_id = self.refs.pop(uid)
+            values['activity_id'] = self.catalog.get_activity_id(activity_ext_id)
+            values['run_id'] = self.catalog.get_run_id(run_ext_id)
+            event = self.existing.get(uid)
+            if event is None:
+                to_create.append(Event(uid=uid, **values))
+            else:
+                for name, value in values.items():
+                    setattr(event, name, value)
+                to_update.append(event)
+        with transaction.atomic(), phase('events'):
+            if to_create:
+                Event.objects.bulk_create(to_create, batch_size=self.batch_size)
+                ids = dict(Event.objects.filter(uid__in=[e.uid for e in to_create]).values_list('uid', 'id'))
+                for e in to_create:
+                    e.id = ids[e.uid]
+                    self.existing[e.uid] = e
+                self.stats.add('events_inserted', len(to_create))
+            if to_update:
+                bulk_update(to_update, self.EVENT_FIELDS, batch_size=self.batch_size)
+                self.stats.add('events_updated', len(to_update))
+            if self.refresh_participants:
+                self.sync_entries({self.existing[uid].id: (participants, checked)
+                                   for uid, (_, participants, checked) in pending.items()})
+
+    def get_checked_users(self, check_ins):
+        checked = set()
+        for check_in in check_ins:
+            user_id = self.unti_id_to_user_id.get(int(check_in['user']['unti_id']))
+            if user_id:
+                checked.add(user_id)
+        return checked
+
+    def sync_entries(self, events):
+        """
+        создание недостающих записей на эвенты и проставление чекинов, events - словарь
+        {id эвента: (unti_id участников, id пользователей с чекином)}
+        """
+        entries = defaultdict(dict)
+        with phase('entries'):
+            for batch in chunks(events, self.batch_size):
+                for entry_id, event_id, user_id, is_active, added_by_assistant in EventEntry.all_objects.filter(
+                        event_id__in=batch).values_list('id', 'event_id', 'user_id', 'is_active',
+                                                        'added_by_assistant'):
+                    entries[event_id][user_id] = (entry_id, is_active, added_by_assistant)
+        to_create, activate, deactivate = [], [], []
+        for event_id, (participant_ids, checked) in events.items():
+            event_entries = entries[event_id]
+            for ptcpt in participant_ids:
+                user_id = self.unti_id_to_user_id.get(ptcpt)
+                if not user_id:
+                    logging.error('User with unti_id %s not found' % ptcpt)
+                    continue
+                if user_id not in event_entries:
+                    event_entries[user_id] = (None, user_id in checked, False)
+                    to_create.append(EventEntry(event_id=event_id, user_id=user_id, is_active=user_id in checked))
+            for user_id, (entry_id, is_active, added_by_assistant) in event_entries.items():
+                if entry_id is None:
+                    continue
+                if user_id in checked:
+                    if not is_active:
+                        activate.append(entry_id)
+                elif is_active and not added_by_assistant:
+                    deactivate.append(entry_id)
+        with phase('entries'):
+            EventEntry.all_objects.bulk_create(to_create, batch_size=self.batch_size)
+            update_entry_counts({entry.event_id for entry in to_create}, self.batch_size)
+        with phase('check_ins'):
+            for ids, value in ((activate, True), (deactivate, False)):
+                for batch in chunks(ids, self.batch_size):
+                    EventEntry.all_objects.filter(id__in=batch).update(is_active=value)
+        self.stats.add('entries_inserted', len(to_create))
+        self.stats.add('entries_updated', len(activate) + len(deactivate))
+
+    def finish(self):
+        self.flush()
+        self.catalog.flush()
+        self.flush_index()
+        if not self.refresh_for_events:
+            with phase('cleanup'):
+                self.delete_missing_events()
+        return self.stats
+
+    def delete_missing_events(self):
+        """
+        эвенты, пропавшие из данных ILE, становятся недоступными для оцифровки, а если они
+        запланированы как минимум на следующий день, то удаляются. Хеш у них сбрасывается, чтобы
+        при повторном появлении эвента в ILE он был обновлен
+        """
+        delete_events = self.existing_uids - self.fetched_events
+        if self.build_index:
+            self.index_cache.delete_many([EVENT_INDEX_CACHE_KEY % uid for uid in delete_events])
+        for batch in chunks(delete_events, self.batch_size):
+            self.stats.add('events_deactivated', Event.objects.filter(uid__in=batch).
+                           exclude(is_active=False, fingerprint='').update(is_active=False, fingerprint=''))
+        # если произошли изменения в списке будущих эвентов
+        dt = timezone.now() + timezone.timedelta(days=1)
+        delete_events = [uid for uid in delete_events if self.existing[uid].dt_start > dt]
+        if delete_events:
+            logging.warning('Event(s) with uuid: {} were deleted'.format(', '.join(delete_events)))
+            for batch in chunks(delete_events, self.batch_size):
+                Event.objects.filter(uid__in=batch).delete()
+            self.stats.add('events_deleted', len(delete_events))
@@ -0,0 +1,124 @@
+import json
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+from django.db import connection
+
+_current = None
+
+
+class SyncTelemetry:
+    """
+    Замеры синхронизации по фазам: время, количество запросов к базе, строки, измененные этими
+    запросами, и (при trace_memory=True) пиковый прирост памяти по tracemalloc. Фазы отмечаются
+    через phase(name) в коде синхронизации, вложенная фаза приостанавливает внешнюю. Замеры ведутся
+    только в потоке, в котором вызван collect, а все, что не попало ни в одну фазу, относится к other
+    """
+    ROOT = 'other'
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.phases = OrderedDict()
+        self.stack = []
+        self.thread = None
+        self.mark = None
+        self.started = None
+        self.finished = None
+
+    @contextmanager
+    def collect(self):
+        global _current
+        self.thread = threading.current_thread()
+        self.started = time.time()
+        if self.trace_memory:
+            tracemalloc.start()
+        _current = self
+        try:
+            with connection.execute_wrapper(self.count_query), self.phase(self.ROOT):
+                yield self
+        finally:
+            _current = None
+            if self.trace_memory:
+                tracemalloc.stop()
+            self.finished = time.time()
+
+    @contextmanager
+    def phase(self, name):
+        if threading.current_thread() is not self.thread:
+            yield
+            return
+        self.switch()
+        self.stack.append(name)
+        data = self.phases.setdefault(name, {'time': 0, 'calls': 0, 'queries': 0, 'rows': 0, 'memory_peak': 0})
+        data['calls'] += 1
+        try:
+            yield
+        finally:
+            self.switch()
+            self.stack.pop()
+
+    def switch(self):
+        """
+        отнесение времени и памяти с прошлого переключения к текущей фазе
+        """
+        now = time.perf_counter()
+        if self.stack:
+            data = self.phases[self.stack[-1]]
+            data['time'] += now - self.mark
+            if self.trace_memory:
+                data['memory_peak'] = max(data['memory_peak'], tracemalloc.get_traced_memory()[1])
+        if self.trace_memory:
+            tracemalloc.clear_traces()
+        self.mark = now
+
+    def count_query(self, execute, sql, params, many, context):
+        result = execute(sql, params, many, context)
+        if self.stack and threading.current_thread() is self.thread:
+            data = self.phases[self.stack[-1]]
+            data['queries'] += 1
+            if sql.lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+                data['rows'] += max(context['cursor'].rowcount, 0)
+        return result
+
+    @property
+    def duration(self):
+        return (self.finished or time.time()) - (self.started or time.time())
+
+    def summary(self):
+        phases = OrderedDict()
+        for name, data in self.phases.items():
+            phases[name] = dict(data, time=round(data['time'], 3))
+            if not self.trace_memory:
+                del phases[name]['memory_peak']
+        return {'duration': round(self.duration, 3), 'phases': phases}
+
+    def to_json(self, **extra):
+        return json.dumps(dict(self.summary(), **extra), ensure_ascii=False)
+
+
+@contextmanager
+def phase(name):
+    """
+    отметка фазы синхронизации для замеров, если они ведутся
+    """
+    if _current is None:
+        yield
+    else:
+        with _current.phase(name):
+            yield
+
+
+def timed(iterable, name):
+    """
+    итерация по iterable, при которой получение каждого элемента относится к фазе name
+    """
+    iterator = iter(iterable)
+    while True:
+        with phase(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
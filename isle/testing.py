@@ -0,0 +1,223 @@
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from requests.adapters import HTTPAdapter
+
+# unti_id синтетических пользователей начинаются с этого значения, чтобы не пересекаться с настоящими
+USERS_UNTI_ID_FROM = 10 ** 9
+
+
+class RecordingAdapter(HTTPAdapter):
+    """
+    Транспорт для проверки переиспользования keep-alive соединений: считает отправленные запросы
+    и соединения, открытые пулами. Подключается вместо обычного транспорта так:
+
+        session = make_session(RecordingAdapter)
+        set_session(session)
+        ...
+        adapter = session.get_adapter(url)
+        adapter.requests_sent, adapter.connections_opened, adapter.connections_reused
+    """
+    def __init__(self, *args, **kwargs):
+        self.pools = []
+        self.requests_sent = 0
+        super().__init__(*args, **kwargs)
+
+    def get_connection(self, url, proxies=None):
+        pool = super().get_connection(url, proxies)
+        if pool not in self.pools:
+            self.pools.append(pool)
+        return pool
+
+    def send(self, request, **kwargs):
+        self.requests_sent += 1
+        return super().send(request, **kwargs)
+
+    @property
+    def connections_opened(self):
+        return sum(pool.num_connections for pool in self.pools)
+
+    @property
+    def connections_reused(self):
+        return self.requests_sent - self.connections_opened
+
+
+def make_activities(activities=10, runs=2, events=3, participants=20, users=100, check_ins=5, seed=0):
+    """
+    синтетические активности в формате ILE: activities активностей по runs прогонов, в каждом по events
+    эвентов и participants участников из users пользователей (unti_id от USERS_UNTI_ID_FROM),
+    на каждом эвенте check_ins чекинов участников прогона
+    """
+    rnd = random.Random(seed)
+    data = []
+    event_id = 0
+    for a in range(activities):
+        activity = {
+            'id': a + 1, 'ext_id': 100000 + a, 'uuid': str(uuid.UUID(int=rnd.getrandbits(128))),
+            'title': 'Активность %s' % (a + 1), 'authors': [{'title': 'Автор %s' % (a % 7)}], 'rates': [],
+            'activity_type': {'id': a % 3 + 1, 'title': 'Тип %s' % (a % 3 + 1), 'description': ''},
+            'runs': [],
+        }
+        for r in range(runs):
+            user_ids = rnd.sample(range(users), min(participants, users))
+            run = {
+                'id': a * runs + r + 1, 'ext_id': 200000 + a * runs + r, 'bets': [],
+                'assignments': [{'user': {'unti_id': USERS_UNTI_ID_FROM + i}} for i in user_ids],
+                'events': [],
+            }
+            for e in range(events):
+                event_id += 1
+                start = datetime(2030, 1, 1, 10) + timedelta(hours=event_id)
+                run['events'].append({
+                    'uuid': str(uuid.UUID(int=rnd.getrandbits(128))), 'id': event_id, 'ext_id': 300000 + event_id,
+                    'is_delete': False, 'title': 'Эвент %s' % event_id,
+                    'time_slot': {'time_start': start.isoformat() + '+00:00',
+                                  'time_end': (start + timedelta(hours=1)).isoformat() + '+00:00'},
+                    'check_ins': [{'user': {'unti_id': USERS_UNTI_ID_FROM + i}}
+                                  for i in user_ids[:min(check_ins, len(user_ids))]],
+                })
+            activity['runs'].append(run)
+        data.append(activity)
+    return data
+
+
+def make_traces(activities, traces=20, events_per_trace=10, seed=0):
+    """
+    синтетические результаты в формате LABS, привязанные к случайным эвентам из activities
+    """
+    rnd = random.Random(seed)
+    uids = [e['uuid'] for a in activities for r in a['runs'] for e in r['events']]
+    return [{'id': i + 1, 'title': 'Тип результата %s' % (i % 5), 'description': 'Результат %s' % (i + 1),
+             'events': rnd.sample(uids, min(events_per_trace, len(uids)))} for i in range(traces)]
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """
+    Локальная замена ILE и LABS для замеров: отдает токен, снэпшот, постраничный список активностей,
+    чекины эвентов и результаты, принимает проставление чекинов. Снэпшот и результаты отдаются с ETag
+    и поддерживают условные запросы. Все активности считаются измененными в момент создания сервера,
+    поэтому запрос измененных позже активностей возвращает пустой список. Запускается в отдельном потоке:
+
+        server = StubServer(make_activities(...), make_traces(...))
+        server.start()
+        ... запросы к server.url ...
+        server.stop()
+    """
+    daemon_threads = True
+    TOKEN_PATH = '/api/token/'
+    SNAPSHOT_PATH = '/api/snapshot/'
+    TRACES_PATH = '/api/traces/'
+
+    def __init__(self, activities, traces=(), latency=0):
+        super().__init__(('127.0.0.1', 0), StubRequestHandler)
+        self.latency = latency
+        self.counters = Counter()
+        # страницы списка активностей, на которые сервер отвечает 503, чтобы прервать синхронизацию
+        self.failing_pages = set()
+        self.set_activities(activities)
+        self.set_traces(traces)
+
+    def set_activities(self, activities):
+        """
+        замена отдаваемых активностей, например чтобы смоделировать изменения в ILE между синхронизациями
+        """
+        self.activities = activities
+        self.check_ins = {e['id']: e['check_ins'] for a in activities for r in a['runs'] for e in r['events']}
+        self.snapshot = self.encode({'activities': activities})
+        self.updated_at = timezone.now()
+
+    def set_traces(self, traces):
+        self.traces = list(traces)
+        self.traces_body = self.encode(self.traces)
+
+    @staticmethod
+    def encode(data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        return body, '"%s"' % hashlib.sha1(body).hexdigest()
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server_address
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body, status=200, etag=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data, status=200):
+        self.send_body(json.dumps(data, ensure_ascii=False).encode('utf-8'), status=status)
+
+    def send_conditional(self, body, etag):
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            self.send_body(body, etag=etag)
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        server.counters[url.path] += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if url.path == server.TOKEN_PATH:
+            self.send_json({'token': 'stub', 'duration': 3600})
+        elif url.path == server.SNAPSHOT_PATH:
+            self.send_conditional(*server.snapshot)
+        elif url.path == server.TRACES_PATH:
+            self.send_conditional(*server.traces_body)
+        elif url.path == '/api/activity/list/':
+            page, per_page = int(query['_page'][0]), int(query['_per_page'][0])
+            if page in server.failing_pages:
+                self.send_json({}, status=503)
+                return
+            activities = server.activities[(page - 1) * per_page:page * per_page]
+            updated_since = query.get(getattr(settings, 'ILE_UPDATED_SINCE_PARAM', 'updated_since'))
+            if updated_since and parse_datetime(updated_since[0]) > server.updated_at:
+                activities = []
+            if activities:
+                self.send_json(activities)
+            else:
+                self.send_json({}, status=404)
+        elif url.path == '/api/check_in/list/':
+            self.send_json(server.check_ins.get(int(query['event_id'][0]), []))
+        else:
+            self.send_json({}, status=404)
+
+    def do_POST(self):
+        self.server.counters[urlparse(self.path).path] += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_json({})
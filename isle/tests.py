@@ -0,0 +1,759 @@
+import copy
+import io
+import json
+import requests
+import shutil
+import tempfile
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.admin.sites import site
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+from isle.admin import EventTypeAdmin
+from isle.counters import rebuild_material_counters
+from isle.api import Api, JsonStream, _token_store, make_session, send_request, set_session
+from isle.jobs import claim_job, enqueue_refresh
+from isle.locks import DbLock
+from isle.models import Attendance, Event, EventEntry, EventMaterial, EventOnlyMaterial, EventType, \
+    EventTeamMaterial, MaterialCounter, SyncCheckpoint, SyncJob, SyncRun, Team, Trace, User
+from isle.sync import EVENT_INDEX_CACHE_KEY, EventsSync, SyncStats, get_indexed_activities, sync_traces
+from isle.testing import USERS_UNTI_ID_FROM, StubServer, make_activities, make_traces
+from isle.traces import get_traces_cache, get_traces_version
+from isle.utils import ACTIVITIES_WATERMARK_CACHE_KEY, EVENTS_SYNC_LOCK, V2_SYNC_CHECKPOINT, refresh_events_data, \
+    refresh_events_data_v2, update_events_traces
+
+
+class JsonStreamTestCase(SimpleTestCase):
+    PAYLOAD = json.dumps({
+        'meta': {'total': 5, 'ratio': 1.5e-3},
+        'activities': [
+            -0.5, 0, -0, 12, 3.25, 1e5, -2E-3, 10.0, True, False, None, 'строка', '',
+            {'uuid': 'a1', 'title': 'Активность', 'runs': [{'events': [1, -0.25, {'x': None}]}]},
+            [], {}, [[1.5], -7],
+        ],
+        'tail': [1, 2],
+    }, ensure_ascii=False).encode('utf-8')
+
+    def parse(self, chunks):
+        return list(JsonStream(chunks).iter_list('activities'))
+
+    def test_split_at_every_offset(self):
+        """
+        документ, разрезанный на две части по любому байту, разбирается так же, как целиком
+        """
+        expected = json.loads(self.PAYLOAD.decode('utf-8'))['activities']
+        for i in range(len(self.PAYLOAD) + 1):
+            with self.subTest(offset=i):
+                self.assertEqual(self.parse([self.PAYLOAD[:i], self.PAYLOAD[i:]]), expected)
+
+    def test_single_byte_chunks(self):
+        expected = json.loads(self.PAYLOAD.decode('utf-8'))['activities']
+        chunks = [self.PAYLOAD[i:i + 1] for i in range(len(self.PAYLOAD))]
+        self.assertEqual(self.parse(chunks), expected)
+
+    def test_negative_zero_fraction(self):
+        self.assertEqual(self.parse([b'{"activities": [-0.', b'5]}']), [-0.5])
+        self.assertEqual(self.parse([b'{"activities": [1e', b'2, 3]}']), [100.0, 3])
+
+
+class FailingAdapter(HTTPAdapter):
+    """
+    транспорт, который не отправляет запросы, а запоминает их методы и отвечает кодом status
+    или выбрасывает исключение error
+    """
+    def __init__(self, status=503, error=None):
+        super().__init__()
+        self.status = status
+        self.error = error
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        self.sent.append(request.method)
+        if self.error is not None:
+            raise self.error
+        response = requests.Response()
+        response.status_code = self.status
+        response.request = request
+        return response
+
+
+@override_settings(ILE_MAX_RETRIES=3, ILE_RETRY_BACKOFF=0)
+class SendRequestTestCase(SimpleTestCase):
+    def send(self, method, **kwargs):
+        adapter = FailingAdapter(**kwargs)
+        set_session(make_session(lambda **_: adapter))
+        self.addCleanup(set_session, None)
+        try:
+            return send_request(method, 'http://ile.test/api/'), adapter.sent
+        except requests.RequestException:
+            return None, adapter.sent
+
+    def test_retry_idempotent(self):
+        self.assertEqual(self.send('get')[1], ['GET'] * 4)
+        self.assertEqual(self.send('get', error=requests.ReadTimeout())[1], ['GET'] * 4)
+        r, sent = self.send('get', status=404)
+        self.assertEqual((r.status_code, sent), (404, ['GET']))
+
+    def test_no_retry_after_send(self):
+        r, sent = self.send('post')
+        self.assertEqual((r.status_code, sent), (503, ['POST']))
+        self.assertEqual(self.send('post', error=requests.ReadTimeout())[1], ['POST'])
+        self.assertEqual(self.send('post', error=requests.ConnectionError('reset'))[1], ['POST'])
+
+    def test_retry_post_not_sent(self):
+        """
+        POST повторяется, если соединение не было установлено
+        """
+        self.assertEqual(self.send('post', error=requests.ConnectTimeout())[1], ['POST'] * 4)
+        refused = MaxRetryError(None, '/', NewConnectionError(None, 'refused'))
+        self.assertEqual(self.send('post', error=requests.ConnectionError(refused))[1], ['POST'] * 4)
+
+
+class StubServerMixin:
+    """
+    запуск локального сервера-заглушки ILE и LABS на время теста, кеши очищаются до и после теста
+    """
+    def start_server(self, activities, traces=()):
+        self.server = StubServer(activities, traces)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        override = override_settings(ILE_BASE_URL=self.server.url, ILE_TOKEN_PATH=StubServer.TOKEN_PATH,
+                                     ILE_SNAPSHOT_PATH=StubServer.SNAPSHOT_PATH,
+                                     LABS_TRACES_API_URL=self.server.url + StubServer.TRACES_PATH)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.clear_caches()
+        self.addCleanup(self.clear_caches)
+
+    def clear_caches(self):
+        for alias in settings.CACHES:
+            caches[alias].clear()
+        _token_store.set(None, 0, 0)
+
+
+class SnapshotSyncTestCase(StubServerMixin, TestCase):
+    """
+    построчное поведение синхронизации по снэпшоту, которое должно совпадать с исходной реализацией
+    """
+    def setUp(self):
+        User.objects.bulk_create([User(username='user_%s' % i, unti_id=USERS_UNTI_ID_FROM + i, icon={})
+                                  for i in range(6)])
+        self.activities = make_activities(2, runs=1, events=2, participants=4, users=6, check_ins=2)
+        self.start_server(self.activities)
+
+    def refresh(self, refresh_participants=True):
+        # без валидаторов снэпшот обрабатывается заново, даже если не изменился
+        caches['default'].delete(Api.EVENTS_VALIDATORS_CACHE_KEY)
+        stats = SyncStats()
+        self.assertTrue(refresh_events_data(force=True, refresh_participants=refresh_participants, stats=stats))
+        return stats.counters
+
+    def events(self):
+        return [e for a in self.activities for r in a['runs'] for e in r['events']]
+
+    def entry(self, event_uid, num):
+        unti_id = self.activities[0]['runs'][0]['assignments'][num]['user']['unti_id']
+        return EventEntry.all_objects.get(event__uid=event_uid, user__unti_id=unti_id)
+
+    def test_missing_events(self):
+        """
+        пропавший из снэпшота эвент становится неактивным, а если он запланирован позже чем через день -
+        удаляется
+        """
+        self.refresh()
+        past, future = self.activities[0]['runs'][0]['events']
+        Event.objects.filter(uid=past['uuid']).update(dt_start=timezone.now() - timedelta(hours=1))
+        self.activities[0]['runs'][0]['events'] = []
+        self.server.set_activities(self.activities)
+        counters = self.refresh()
+        self.assertEqual((counters['events_deactivated'], counters['events_deleted']), (2, 1))
+        event = Event.objects.get(uid=past['uuid'])
+        self.assertEqual((event.is_active, event.fingerprint), (False, ''))
+        self.assertFalse(Event.objects.filter(uid=future['uuid']).exists())
+        self.assertEqual(Event.objects.filter(is_active=True).count(), 2)
+
+    def test_entries(self):
+        """
+        чекины снимаются только при обновлении участников, записи, добавленные ассистентом, сохраняются,
+        а удаленные записи не восстанавливаются
+        """
+        self.refresh()
+        uid = self.events()[0]['uuid']
+        self.assertEqual(EventEntry.objects.filter(event__uid=uid).count(), 4)
+        self.assertEqual(EventEntry.objects.filter(event__uid=uid, is_active=True).count(), 2)
+        EventEntry.all_objects.filter(id=self.entry(uid, 2).id).update(added_by_assistant=True, is_active=True)
+        EventEntry.all_objects.filter(id=self.entry(uid, 3).id).update(deleted=True)
+        self.events()[0]['check_ins'] = []
+        self.server.set_activities(self.activities)
+        self.refresh(refresh_participants=False)
+        self.assertEqual([self.entry(uid, i).is_active for i in range(4)], [True, True, True, False])
+        self.refresh()
+        self.assertEqual([self.entry(uid, i).is_active for i in range(4)], [False, False, True, False])
+        self.assertTrue(self.entry(uid, 3).deleted)
+        self.assertEqual(EventEntry.all_objects.filter(event__uid=uid).count(), 4)
+
+    def test_refresh_without_participants_then_full(self):
+        """
+        обновление по кнопке (без участников) не помечает снэпшот обработанным для полного обновления
+        """
+        self.assertTrue(refresh_events_data(force=True))
+        self.assertEqual((Event.objects.count(), EventEntry.objects.count()), (4, 0))
+        self.assertTrue(refresh_events_data(force=True, refresh_participants=True))
+        self.assertEqual(EventEntry.objects.count(), 16)
+        requests_before = self.server.counters[StubServer.SNAPSHOT_PATH]
+        stats = SyncStats()
+        self.assertTrue(refresh_events_data(force=True, refresh_participants=True, stats=stats))
+        self.assertEqual(self.server.counters[StubServer.SNAPSHOT_PATH], requests_before + 1)
+        self.assertFalse(stats.counters)
+
+    def test_fingerprint(self):
+        """
+        неизменившиеся эвенты пропускаются по хешу, но хеш сохраняется только при обновлении участников
+        """
+        self.assertEqual(self.refresh(refresh_participants=False)['events_inserted'], 4)
+        self.assertEqual(set(Event.objects.values_list('fingerprint', flat=True)), {''})
+        counters = self.refresh(refresh_participants=False)
+        self.assertEqual((counters['events_updated'], counters['events_unchanged']), (4, 0))
+        counters = self.refresh()
+        self.assertEqual((counters['events_updated'], counters['events_unchanged']), (4, 0))
+        self.assertNotIn('', set(Event.objects.values_list('fingerprint', flat=True)))
+        uid = self.events()[0]['uuid']
+        Event.objects.filter(uid=uid).update(title='changed')
+        counters = self.refresh()
+        self.assertEqual((counters['events_updated'], counters['events_unchanged']), (0, 4))
+        self.assertEqual(Event.objects.get(uid=uid).title, 'changed')
+        self.events()[0]['title'] = 'new title'
+        self.server.set_activities(self.activities)
+        counters = self.refresh()
+        self.assertEqual((counters['events_updated'], counters['events_unchanged']), (1, 3))
+        self.assertEqual(Event.objects.get(uid=uid).title, self.activities[0]['title'])
+
+
+    def test_forced_event_refresh_ignores_index(self):
+        """
+        принудительное обновление отдельного эвента берет данные из ILE, а не из индекса
+        """
+        self.refresh()
+        uid = self.events()[0]['uuid']
+        self.assertIsNotNone(get_indexed_activities([uid]))
+        self.activities[0]['title'] = 'new title'
+        self.server.set_activities(self.activities)
+        requests_before = self.server.counters[StubServer.SNAPSHOT_PATH]
+        self.assertTrue(refresh_events_data(force=True, refresh_participants=True, refresh_for_events=[uid]))
+        self.assertEqual(self.server.counters[StubServer.SNAPSHOT_PATH], requests_before + 1)
+        self.assertEqual(Event.objects.get(uid=uid).title, 'new title')
+        self.assertTrue(refresh_events_data(refresh_participants=True, refresh_for_events=[uid]))
+        self.assertEqual(self.server.counters[StubServer.SNAPSHOT_PATH], requests_before + 1)
+        self.assertEqual(Event.objects.get(uid=uid).title, 'new title')
+
+
+class EventsTracesTestCase(StubServerMixin, TestCase):
+    def test_new_events_linked_without_traces_change(self):
+        """
+        трейсы, полученные до появления их эвентов, привязываются к эвентам при следующем обновлении,
+        даже если LABS отвечает 304
+        """
+        activities = make_activities(2, runs=1, events=2, participants=0, users=0, check_ins=0)
+        self.start_server(activities, make_traces(activities, traces=3, events_per_trace=2))
+        update_events_traces()
+        self.assertEqual(Trace.objects.count(), 3)
+        self.assertFalse(Trace.events.through.objects.exists())
+        self.assertTrue(refresh_events_data(force=True))
+        update_events_traces()
+        self.assertEqual(Trace.events.through.objects.count(), 6)
+        requests_before = self.server.counters[StubServer.TRACES_PATH]
+        stats = SyncStats()
+        update_events_traces(stats=stats)
+        self.assertEqual(self.server.counters[StubServer.TRACES_PATH], requests_before + 1)
+        self.assertFalse(stats.counters)
+
+
+@override_settings(USE_ILE_SNAPSHOT=True, SAVE_SYNC_RUNS=True, SYNC_RUNS_KEEP_DAYS=30)
+class UpdateEventsCommandTestCase(StubServerMixin, TestCase):
+    def test_runs_history(self):
+        """
+        замеры запуска не выводятся без --stats, а история запусков хранится SYNC_RUNS_KEEP_DAYS дней
+        """
+        activities = make_activities(1, runs=1, events=1, participants=0, users=0, check_ins=0)
+        self.start_server(activities, make_traces(activities, traces=1))
+        for days in (31, 29):
+            SyncRun.objects.create(command='update_events', started_on=timezone.now() - timedelta(days=days),
+                                   duration=1)
+        out = io.StringIO()
+        call_command('update_events', stdout=out)
+        self.assertEqual(out.getvalue(), '')
+        self.assertEqual(Event.objects.count(), 1)
+        self.assertEqual(SyncRun.objects.count(), 2)
+        self.assertTrue(SyncRun.objects.filter(started_on__gt=timezone.now() - timedelta(days=1)).exists())
+        call_command('update_events', '--stats', stdout=out)
+        self.assertEqual(json.loads(out.getvalue().splitlines()[0])['command'], 'update_events')
+
+
+class EventsSyncTestCase(TestCase):
+    def setUp(self):
+        User.objects.bulk_create([User(username='user_%s' % i, unti_id=USERS_UNTI_ID_FROM + i, icon={})
+                                  for i in range(5)])
+
+    def sync(self, activities, batch_size=500):
+        sync = EventsSync(refresh_participants=True, batch_size=batch_size)
+        for activity in activities:
+            sync.add_activity(activity)
+        return sync.finish()
+
+    def test_duplicate_uid_last_occurrence_wins(self):
+        """
+        эвент, встречающийся в нескольких активностях, сохраняется по последнему вхождению и не
+        перезаписывается первым при повторной синхронизации неизменившихся данных
+        """
+        activities = make_activities(3, runs=1, events=1, participants=2, users=5)
+        activities[2]['runs'][0]['events'].append(copy.deepcopy(activities[0]['runs'][0]['events'][0]))
+        uid = activities[0]['runs'][0]['events'][0]['uuid']
+        for batch_size in (500, 1):
+            for _ in range(3):
+                self.sync(activities, batch_size)
+                event = Event.objects.select_related('event_type').get(uid=uid)
+                self.assertEqual(event.title, activities[2]['title'])
+                self.assertEqual(event.event_type.ext_id, activities[2]['activity_type']['id'])
+
+    def test_events_index_uses_separate_cache(self):
+        activities = make_activities(2, runs=1, events=1, participants=2, users=5)
+        uids = [a['runs'][0]['events'][0]['uuid'] for a in activities]
+        key = EVENT_INDEX_CACHE_KEY % uids[0]
+        sync = EventsSync(build_index=True)
+        for activity in activities:
+            sync.add_activity(activity)
+        sync.finish()
+        self.assertIsNotNone(caches['events_index'].get(key))
+        self.assertIsNone(caches['default'].get(key))
+        self.assertEqual([a['runs'][0]['events'][0]['uuid'] for a in get_indexed_activities(uids)], uids)
+        caches['events_index'].clear()
+        with override_settings(EVENTS_INDEX_CACHE='default'):
+            sync = EventsSync(build_index=True)
+            for activity in activities:
+                sync.add_activity(activity)
+            sync.finish()
+            self.assertIsNone(caches['default'].get(key))
+            self.assertIsNone(get_indexed_activities(uids))
+
+
+@override_settings(ACTIVITIES_PER_PAGE=2, ACTIVITIES_PREFETCH_PAGES=1, SYNC_CHECKPOINT_EVERY=1, ILE_MAX_RETRIES=0)
+class PaginatedSyncTestCase(StubServerMixin, TestCase):
+    """
+    постраничная синхронизация: продолжение с сохраненной страницы и сдвиг watermark
+    """
+    PAGES_PATH = '/api/activity/list/'
+
+    def setUp(self):
+        User.objects.bulk_create([User(username='user_%s' % i, unti_id=USERS_UNTI_ID_FROM + i, icon={})
+                                  for i in range(6)])
+        self.activities = make_activities(6, runs=1, events=2, participants=3, users=6, check_ins=1)
+        self.uids = {e['uuid'] for a in self.activities for r in a['runs'] for e in r['events']}
+        self.start_server(self.activities)
+
+    def watermark(self):
+        return caches['default'].get(ACTIVITIES_WATERMARK_CACHE_KEY)
+
+    def test_resume_from_checkpoint(self):
+        """
+        прерванное полное обновление продолжается с сохраненной страницы, ни один эвент не теряется и
+        не обрабатывается дважды, а пропавшие эвенты удаляются только после получения всех страниц
+        """
+        make_event('gone', ext_id=10 ** 6, dt_start=timezone.now() + timedelta(days=2))
+        self.server.failing_pages = {3}
+        self.assertFalse(refresh_events_data_v2(full=True))
+        checkpoint = SyncCheckpoint.objects.get(name=V2_SYNC_CHECKPOINT)
+        self.assertEqual(checkpoint.page, 2)
+        self.assertEqual(len(checkpoint.fetched_uids), 8)
+        self.assertEqual(Event.objects.count(), 9)
+        self.assertIsNone(self.watermark())
+        self.assertEqual(self.server.counters[self.PAGES_PATH], 3)
+        self.server.failing_pages = set()
+        self.assertTrue(refresh_events_data_v2())
+        # запрошены только третья страница и несуществующая четвертая
+        self.assertEqual(self.server.counters[self.PAGES_PATH], 5)
+        self.assertEqual(set(Event.objects.values_list('uid', flat=True)), self.uids)
+        self.assertEqual(EventEntry.all_objects.count(), 12 * 3)
+        self.assertFalse(SyncCheckpoint.objects.exists())
+        self.assertIsNotNone(self.watermark())
+
+    def test_watermark(self):
+        """
+        watermark сдвигается только после успешного обновления
+        """
+        self.assertTrue(refresh_events_data_v2())
+        watermark = self.watermark()
+        self.server.failing_pages = {1}
+        self.assertFalse(refresh_events_data_v2())
+        self.assertEqual(self.watermark(), watermark)
+        self.assertFalse(SyncCheckpoint.objects.exists())
+        self.server.failing_pages = set()
+        self.assertTrue(refresh_events_data_v2())
+        self.assertGreater(self.watermark(), watermark)
+
+
+def make_event(uid, **kwargs):
+    dt_start = timezone.now() + timedelta(days=1)
+    values = dict(uid=uid, ile_id=1, ext_id=1, title=uid, data={}, is_active=True, dt_start=dt_start,
+                  dt_end=dt_start + timedelta(hours=1))
+    values.update(kwargs)
+    return Event.objects.create(**values)
+
+
+class EventViewTestCase(TestCase):
+    def make_participants(self, event, num):
+        """
+        участники эвента с материалами, подтвержденным присутствием и командами
+        """
+        trace = Trace.objects.create(trace_type='t', name='trace')
+        trace.events.add(event)
+        for i in range(num):
+            user = User.objects.create(username='%s_%s' % (event.uid, i), unti_id=event.id * 1000 + i, icon={})
+            EventEntry.objects.create(event=event, user=user, is_active=bool(i % 2))
+            EventMaterial.objects.create(event=event, user=user, trace=trace, url='http://example.com/%s' % i,
+                                         is_public=True, initiator=user.unti_id)
+            Attendance.objects.create(event=event, user=user, confirmed_by_system=Attendance.SYSTEM_CHAT_BOT,
+                                      is_confirmed=True)
+            team = Team.objects.create(event=event, name='team %s' % i, creator=user)
+            team.users.add(user)
+        return user
+
+    def test_query_count_does_not_depend_on_participants(self):
+        for num in (2, 12):
+            event = make_event('event_view_%s' % num)
+            self.client.force_login(self.make_participants(event, num))
+            url = reverse('event-view', kwargs={'uid': event.uid})
+            self.assertEqual(self.client.get(url).status_code, 200)
+            with self.assertNumQueries(7):
+                resp = self.client.get(url)
+            self.assertEqual(len(resp.context['students']), num)
+
+
+@override_settings(INDEX_EVENTS_PAGE_SIZE=2, VISIBLE_EVENT_TYPES=[])
+class IndexPaginationTestCase(TestCase):
+    def setUp(self):
+        self.assistant = User.objects.create(username='assistant', is_assistant=True, icon={})
+        self.client.force_login(self.assistant)
+        self.day = timezone.datetime(2030, 1, 10).date()
+        noon = timezone.make_aware(timezone.datetime.combine(self.day, timezone.datetime.min.time())) + \
+            timedelta(hours=12)
+        # порядок id не совпадает с порядком времени начала
+        starts = [noon + timedelta(hours=1)] + [noon] * 5 + [noon - timedelta(hours=1)]
+        self.events = [make_event('index_%s' % i, ile_id=i + 1, ext_id=i + 1, dt_start=dt)
+                       for i, dt in enumerate(starts)]
+        make_event('index_inactive', ile_id=100, ext_id=100, dt_start=noon, is_active=False)
+        make_event('index_prev_day', ile_id=101, ext_id=101, dt_start=noon - timedelta(days=1))
+        make_event('index_next_day', ile_id=102, ext_id=102, dt_start=noon + timedelta(days=1))
+
+    def walk(self, params):
+        """
+        uid эвентов всех страниц по порядку, начиная с первой
+        """
+        uids, url, pages = [], reverse('index'), 0
+        while url:
+            resp = self.client.get(url, params if not pages else None)
+            self.assertLessEqual(len(resp.context['objects']), 2)
+            uids.extend(e.uid for e in resp.context['objects'])
+            url, pages = resp.context['next_url'], pages + 1
+        return uids
+
+    def test_pages_with_same_start(self):
+        """
+        эвенты с одинаковым временем начала на границе страниц не пропадают и не повторяются при
+        сортировке в обе стороны
+        """
+        expected = [e.uid for e in sorted(self.events, key=lambda e: (e.dt_start, e.id))]
+        params = {'date_from': str(self.day), 'date_to': str(self.day)}
+        self.assertEqual(self.walk(dict(params, sort='asc')), expected)
+        self.assertEqual(self.walk(dict(params, sort='desc')), expected[::-1])
+
+    def test_period_filter(self):
+        """
+        период ассистента ограничивается днями date_from и date_to включительно, с любой стороны
+        """
+        day = str(self.day)
+        next_day = str(self.day + timedelta(days=1))
+        self.assertEqual(len(self.walk({'date_from': day, 'date_to': day})), 7)
+        self.assertEqual(self.walk({'date_from': next_day}), ['index_next_day'])
+        self.assertEqual(self.walk({'date_to': str(self.day - timedelta(days=1))}), ['index_prev_day'])
+        self.assertEqual(len(self.walk({'date_from': day, 'date_to': next_day})), 8)
+        self.assertEqual(len(self.walk({'date': day})), 7)
+
+
+class CountersTestCase(TestCase):
+    """
+    хранимые счетчики должны совпадать с пересчетом по текущим данным
+    """
+    def setUp(self):
+        self.assistant = User.objects.create(username='assistant', is_assistant=True, icon={})
+        self.users = [User.objects.create(username='user_%s' % i, unti_id=USERS_UNTI_ID_FROM + i, icon={})
+                      for i in range(3)]
+        self.event = make_event('counters')
+        self.other_event = make_event('counters_other', ile_id=2, ext_id=2)
+        self.trace = Trace.objects.create(trace_type='t', name='a')
+        self.team = Team.objects.create(event=self.event, name='team')
+
+    def create_materials(self, event, team):
+        user, url = self.users[0], 'http://example.com'
+        return [
+            EventMaterial.objects.create(event=event, trace=self.trace, user=user, url=url, initiator=user.id),
+            EventMaterial.objects.create(event=event, trace=self.trace, user=user, url=url,
+                                         initiator=self.assistant.id),
+            EventTeamMaterial.objects.create(event=event, trace=self.trace, team=team, url=url, initiator=user.id),
+            EventOnlyMaterial.objects.create(event=event, trace=self.trace, url=url, initiator=self.assistant.id),
+        ]
+
+    def assertMaterialCountersMatch(self):
+        counters = set(MaterialCounter.objects.exclude(num=0).values_list('event_id', 'is_user', 'num'))
+        rebuild_material_counters()
+        self.assertEqual(set(MaterialCounter.objects.values_list('event_id', 'is_user', 'num')), counters)
+
+    def assertEventCountersMatch(self):
+        for event in Event.objects.all():
+            materials = [model.objects.filter(event=event).count()
+                         for model in (EventMaterial, EventTeamMaterial, EventOnlyMaterial)]
+            self.assertEqual((event.entry_count, event.trace_count, event.event_only_material_count),
+                             (EventEntry.objects.filter(event=event).count(), sum(materials), materials[2]))
+        for team in Team.objects.all():
+            self.assertEqual(team.traces_number, EventTeamMaterial.objects.filter(team=team).count())
+
+    def test_material_counters(self):
+        """
+        сводка материалов на главной после создания и удаления материалов всех видов
+        """
+        materials = self.create_materials(self.event, self.team)
+        self.create_materials(self.other_event, Team.objects.create(event=self.other_event, name='other'))
+        self.assertEqual(MaterialCounter.objects.get(event=self.event, is_user=True).num, 2)
+        self.assertMaterialCountersMatch()
+        for material in materials:
+            material.delete()
+            self.assertMaterialCountersMatch()
+        self.assertEqual(MaterialCounter.objects.get(event=self.other_event, is_user=False).num, 2)
+
+    def test_event_counters(self):
+        """
+        счетчики эвентов и команд после записи и удаления (мягкого) участников, создания и удаления
+        материалов, в том числе каскадного вместе с командой
+        """
+        self.client.force_login(self.assistant)
+        EventEntry.objects.create(event=self.event, user=self.users[0])
+        EventEntry.objects.create(event=self.event, user=self.users[1])
+        self.assertEventCountersMatch()
+        self.client.post(reverse('add-user', kwargs={'uid': self.event.uid}), {'user': self.users[2].id})
+        self.assertEqual(Event.objects.get(id=self.event.id).entry_count, 3)
+        self.assertEventCountersMatch()
+        resp = self.client.post(reverse('remove-user', kwargs={'uid': self.event.uid}), {'user_id': self.users[2].id})
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(EventEntry.all_objects.get(event=self.event, user=self.users[2]).deleted)
+        self.assertEqual(Event.objects.get(id=self.event.id).entry_count, 2)
+        self.assertEventCountersMatch()
+        self.client.post(reverse('add-user', kwargs={'uid': self.event.uid}), {'user': self.users[2].id})
+        self.assertEqual(Event.objects.get(id=self.event.id).entry_count, 3)
+        self.assertEventCountersMatch()
+        materials = self.create_materials(self.event, self.team)
+        self.create_materials(self.event, self.team)
+        self.assertEqual(Event.objects.get(id=self.event.id).trace_count, 8)
+        self.assertEventCountersMatch()
+        materials[0].delete()
+        EventOnlyMaterial.objects.filter(id=materials[3].id).delete()
+        self.assertEventCountersMatch()
+        self.team.delete()
+        self.assertEqual(Event.objects.get(id=self.event.id).trace_count, 4)
+        self.assertEventCountersMatch()
+
+
+@override_settings(VISIBLE_EVENT_TYPES=[])
+class RefreshCheckInsTestCase(TestCase):
+    def setUp(self):
+        User.objects.bulk_create([User(username='user_%s' % i, unti_id=USERS_UNTI_ID_FROM + i, icon={})
+                                  for i in range(5)])
+        self.assistant = User.objects.create(username='assistant', is_assistant=True, icon={})
+        activities = make_activities(3, runs=1, events=1, participants=3, users=5, check_ins=2)
+        sync = EventsSync(refresh_participants=True)
+        for activity in activities:
+            sync.add_activity(activity)
+        sync.finish()
+        self.server = StubServer(activities)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.addCleanup(caches['default'].clear)
+        self.addCleanup(_token_store.set, None, 0, 0)
+        self.events = list(Event.objects.order_by('dt_start'))
+        # эвент без внешнего id тоже обновляется: чекины запрашиваются по id в ILE
+        Event.objects.filter(id=self.events[0].id).update(ext_id=0)
+        Event.objects.filter(id=self.events[2].id).update(dt_start=self.events[2].dt_start + timedelta(days=5))
+        EventEntry.objects.update(is_active=False)
+
+    def test_refresh_period(self):
+        self.client.force_login(self.assistant)
+        day = timezone.localtime(self.events[0].dt_start).date()
+        params = {'date': '', 'date_from': str(day), 'date_to': str(day + timedelta(days=1))}
+        with override_settings(ILE_BASE_URL=self.server.url, ILE_TOKEN_PATH=StubServer.TOKEN_PATH):
+            resp = self.client.get(reverse('refresh-checkins-view'), params)
+        self.assertEqual(resp.json(), {'success': True, 'updated': 2})
+        checked = {e.id: EventEntry.objects.filter(event=e, is_active=True).count() for e in self.events}
+        self.assertEqual(checked, {self.events[0].id: 2, self.events[1].id: 2, self.events[2].id: 0})
+
+    def test_unbounded_period(self):
+        """
+        период без одной из границ или длиннее CHECK_INS_REFRESH_MAX_DAYS отклоняется без запросов в ILE
+        """
+        self.client.force_login(self.assistant)
+        day = timezone.localtime(self.events[0].dt_start).date()
+        url = reverse('refresh-checkins-view')
+        with override_settings(ILE_BASE_URL=self.server.url, CHECK_INS_REFRESH_MAX_DAYS=3):
+            for params in [{'date_from': str(day)}, {'date_to': str(day)},
+                           {'date_from': str(day), 'date_to': str(day + timedelta(days=3))},
+                           {'date_from': str(day), 'date_to': str(day - timedelta(days=1))}]:
+                self.assertEqual(self.client.get(url, params).status_code, 400)
+            self.assertEqual(self.client.get(url, {'date': str(day + timedelta(days=30))}).json(),
+                             {'success': True, 'updated': 0})
+        self.assertFalse(self.server.counters)
+        self.assertFalse(EventEntry.objects.filter(is_active=True).exists())
+
+
+class SyncJobTestCase(TestCase):
+    def test_enqueue_coalesces_jobs(self):
+        job = enqueue_refresh()
+        self.assertEqual(enqueue_refresh().id, job.id)
+        self.assertNotEqual(enqueue_refresh('uid').id, job.id)
+        # вторую ожидающую задачу на ту же область не дает создать уникальность pending_scope
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            SyncJob.objects.create(scope='', pending_scope='')
+        self.assertEqual(claim_job().id, job.id)
+        self.assertEqual(enqueue_refresh().id, job.id)
+        SyncJob.objects.filter(id=job.id).update(status=SyncJob.STATUS_DONE)
+        new_job = enqueue_refresh()
+        self.assertNotEqual(new_job.id, job.id)
+        self.assertEqual(new_job.status, SyncJob.STATUS_PENDING)
+
+    def test_status_for_anonymous(self):
+        job = enqueue_refresh()
+        resp = self.client.get(reverse('refresh-status-view', kwargs={'job_id': job.id}))
+        self.assertEqual(resp.json(), {'success': False})
+        resp = self.client.get(reverse('refresh-event-view', kwargs={'uid': 'uid'}))
+        self.assertEqual(resp.json(), {'success': False})
+
+
+class DbLockTestCase(StubServerMixin, TestCase):
+    def test_lock(self):
+        """
+        блокировку нельзя захватить, пока она не освобождена или не истек срок ее выдачи, а дождавшиеся
+        владельца получают его результат
+        """
+        owner, other = DbLock('test', lease=60), DbLock('test', lease=60)
+        self.assertTrue(owner.acquire())
+        self.assertFalse(other.acquire())
+        self.assertTrue(other.is_locked())
+        self.assertIsNone(other.wait_result(timeout=0))
+        owner.result = True
+        owner.release()
+        self.assertFalse(other.is_locked())
+        self.assertTrue(other.wait_result(timeout=0))
+        self.assertTrue(DbLock('test', lease=0).acquire())
+        self.assertTrue(other.acquire())
+
+    @override_settings(EVENTS_SYNC_LOCK_LEASE=0)
+    def test_events_sync_not_repeated(self):
+        """
+        обновление эвентов, запрошенное во время уже идущего, не выполняется повторно, а возвращает
+        результат идущего
+        """
+        self.start_server(make_activities(1, runs=1, events=1, participants=0, users=0, check_ins=0))
+        running = DbLock(EVENTS_SYNC_LOCK, lease=60)
+        self.assertTrue(running.acquire())
+        self.assertIsNone(refresh_events_data(force=True))
+        self.assertFalse(self.server.counters)
+        running.result = True
+        running.release()
+        self.assertTrue(refresh_events_data(force=True))
+        self.assertEqual(Event.objects.count(), 1)
+
+
+class TraceCatalogTestCase(TestCase):
+    def setUp(self):
+        self.assistant = User.objects.create(username='assistant', is_assistant=True, icon={})
+        self.client.force_login(self.assistant)
+        self.event_type = EventType.objects.create(ext_id=1, title='type')
+        self.event = make_event('catalog', event_type=self.event_type)
+        self.url = reverse('load-event-materials', kwargs={'uid': self.event.uid})
+        # сброс списков проверяется на общем для процессов кеше, с локальным кешем они не кешируются
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, True)
+        shared_cache = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': cache_dir}
+        override = override_settings(CACHES=dict(settings.CACHES, traces=shared_cache), TRACES_CATALOG_CACHE='traces')
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def page_traces(self):
+        return [(item['trace'].name, [m.url for m in item['links']])
+                for item in self.client.get(self.url).context['traces']]
+
+    def assertVersionChanged(self, func):
+        version = get_traces_version()
+        func()
+        self.assertNotEqual(get_traces_version(), version)
+
+    def test_event_type_traces(self):
+        """
+        изменение списка результатов типа мероприятия в админке сбрасывает закешированный список
+        """
+        admin = EventTypeAdmin(EventType, site)
+        self.event_type.trace_data = [{'trace_type': 't', 'name': 'b'}, {'trace_type': 't', 'name': 'a'}]
+        self.assertVersionChanged(lambda: admin.save_model(None, self.event_type, None, True))
+        self.assertEqual(self.page_traces(), [('b', []), ('a', [])])
+        self.event_type.trace_data = [{'trace_type': 't', 'name': 'a'}, {'trace_type': 't', 'name': 'c'}]
+        self.assertVersionChanged(lambda: admin.save_model(None, self.event_type, None, True))
+        self.assertEqual(self.page_traces(), [('a', []), ('c', [])])
+
+    def test_trace_changes(self):
+        self.assertEqual(self.page_traces(), [])
+        trace = Trace.objects.create(trace_type='t', name='a')
+        self.assertVersionChanged(lambda: trace.events.add(self.event))
+        # результаты, привязанные к эвенту, не выводятся (так работает Event.get_traces)
+        self.assertEqual(self.page_traces(), [])
+        self.assertVersionChanged(lambda: trace.events.remove(self.event))
+        Trace.objects.create(trace_type='t', name='x', event_type=self.event_type)
+        self.assertEqual(self.page_traces(), [('x', [])])
+        self.assertVersionChanged(lambda: Trace.objects.filter(name='x').delete())
+        self.assertEqual(self.page_traces(), [])
+        self.assertVersionChanged(lambda: sync_traces([{'id': 1, 'title': 't', 'description': 'y',
+                                                         'events': [self.event.uid]}]))
+        self.assertEqual(self.page_traces(), [])
+
+    def test_local_cache_not_used(self):
+        """
+        с кешем, локальным для процесса, списки не кешируются, и изменения видны сразу
+        """
+        trace = Trace.objects.create(trace_type='t', name='a', event_type=self.event_type)
+        self.assertEqual(self.page_traces(), [('a', [])])
+        with self.settings(TRACES_CATALOG_CACHE='default'):
+            self.assertIsNone(get_traces_cache())
+            self.assertEqual(self.page_traces(), [('a', [])])
+            Trace.objects.filter(id=trace.id).update(name='b')
+            self.assertEqual(self.page_traces(), [('b', [])])
+        self.assertEqual(self.page_traces(), [('a', [])])
+
+    def test_material_upload_and_delete(self):
+        """
+        материалы не входят в закешированный список результатов и видны на странице сразу после
+        загрузки и удаления
+        """
+        trace = Trace.objects.create(trace_type='t', name='a', event_type=self.event_type)
+        self.assertEqual(self.page_traces(), [('a', [])])
+        version = get_traces_version()
+        resp = self.client.post(self.url, {'trace_name': trace.id, 'add_btn': '1', 'url_field': 'http://example.com'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.page_traces(), [('a', ['http://example.com'])])
+        resp = self.client.post(self.url, {'trace_name': trace.id, 'material_id': resp.json()['material_id']})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.page_traces(), [('a', [])])
+        self.assertFalse(EventOnlyMaterial.objects.exists())
+        self.assertEqual(get_traces_version(), version)
+        resp = self.client.post(self.url, {'trace_name': trace.id + 1, 'add_btn': '1', 'url_field': 'http://a.ru'})
+        self.assertEqual(resp.status_code, 400)
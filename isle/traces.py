@@ -0,0 +1,72 @@
+import uuid
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+TRACES_VERSION_CACHE_KEY = 'TRACES_VERSION'
+
+
+class TraceCatalog:
+    """
+    Список результатов эвента в порядке вывода (как в Event.get_traces) и множество их id для
+    проверки результата при загрузке материалов
+    """
+    def __init__(self, traces):
+        self.traces = list(traces)
+        self.ids = frozenset(t.id for t in self.traces)
+
+    def __iter__(self):
+        return iter(self.traces)
+
+    def __contains__(self, trace_id):
+        return trace_id in self.ids
+
+
+def get_traces_cache():
+    """
+    кеш списков результатов или None, если кеш не общий для процессов: сброс списков дошел бы только
+    до одного процесса, а остальные выдавали бы устаревший список и отклоняли новые результаты
+    """
+    cache = caches[getattr(settings, 'TRACES_CATALOG_CACHE', 'default')]
+    if isinstance(cache, (LocMemCache, DummyCache)):
+        return None
+    return cache
+
+
+def get_traces_version():
+    cache = get_traces_cache()
+    if cache is None:
+        return None
+    version = cache.get(TRACES_VERSION_CACHE_KEY)
+    if version is None:
+        cache.add(TRACES_VERSION_CACHE_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(TRACES_VERSION_CACHE_KEY)
+    return version
+
+
+def invalidate_traces():
+    """
+    сброс закешированных списков результатов всех эвентов сменой версии, старые записи просто
+    перестают читаться и вытесняются по таймауту
+    """
+    cache = get_traces_cache()
+    if cache is not None:
+        cache.set(TRACES_VERSION_CACHE_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def get_trace_catalog(event):
+    """
+    закешированный список результатов эвента, при промахе (или без общего кеша) собирается через
+    Event.get_traces. Тип мероприятия входит в ключ, так как синхронизация эвентов меняет его пачками
+    в обход сигналов
+    """
+    cache = get_traces_cache()
+    if cache is None:
+        return TraceCatalog(event.get_traces())
+    key = 'TRACES_%s_%s_%s' % (get_traces_version(), event.id, event.event_type_id)
+    catalog = cache.get(key)
+    if catalog is None:
+        catalog = TraceCatalog(event.get_traces())
+        cache.set(key, catalog, timeout=getattr(settings, 'TRACES_CATALOG_CACHE_TIME', 60 * 60))
+    return catalog
@@ -8,7 +8,9 @@ urlpatterns = [
     path('logout/', views.logout, name='logout'),
     path('refresh/', views.RefreshDataView.as_view(), name='refresh-view'),
     path('refresh/<str:uid>', views.RefreshDataView.as_view(), name='refresh-event-view'),
+    path('refresh-status/<int:job_id>/', views.RefreshStatusView.as_view(), name='refresh-status-view'),
     path('refresh-checkin/<str:uid>', views.RefreshCheckInView.as_view(), name='refresh-checkin-view'),
+    path('refresh-checkins/', views.RefreshCheckInsView.as_view(), name='refresh-checkins-view'),
     path('update-attendance/<str:uid>', views.UpdateAttendanceView.as_view(), name='update-attendance-view'),
     path('create-team/<str:uid>/', views.CreateTeamView.as_view(), name='create-team'),
     path('confirm-team/<str:uid>/', views.ConfirmTeamView.as_view(), name='confirm-team'),
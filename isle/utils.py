@@ -1,15 +1,28 @@
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from functools import wraps
 from django.conf import settings
-from django.core.cache import caches
+from django.core.cache import cache
+from django.db.models import BooleanField, Case, Count, Max, Q, Value, When
 from django.utils import timezone
 from django.utils.dateparse import parse_datetime
-import requests
-from isle.api import Api, ApiError, ApiNotFound
-from isle.models import Event, EventEntry, User, Trace, EventType
+from isle.api import Api, ApiError, ApiNotFound, send_request, get_conditional_headers, get_validators, \
+    save_validators
+from isle.locks import call_single_flight
+from isle.models import Event, EventEntry, User, EventType, SyncCheckpoint
+from isle.sync import ActivityCatalog, EventsSync, get_authors, get_event_data, get_ext_id, get_indexed_activities, \
+    reconcile_event_entries, sync_traces
+from isle.telemetry import phase, timed
 
-DEFAULT_CACHE = caches['default']
+DEFAULT_CACHE = cache
 EVENT_TYPES_CACHE_KEY = 'EVENT_TYPE_IDS'
+LABS_TRACES_VALIDATORS_CACHE_KEY = 'LABS_TRACES_VALIDATORS'
+EVENTS_SYNC_LOCK = 'EVENTS_SYNC'
+V2_SYNC_CHECKPOINT = 'activities_v2'
+ACTIVITIES_WATERMARK_CACHE_KEY = 'ACTIVITIES_SYNC_WATERMARK'
+ACTIVITIES_FULL_SYNC_CACHE_KEY = 'ACTIVITIES_FULL_SYNC'
 
 
 def get_allowed_event_type_ids():
@@ -20,110 +33,89 @@ def get_allowed_event_type_ids():
     return ids
 
 
-def refresh_events_data(force=False, refresh_participants=False, refresh_for_events=()):
+def events_sync(func):
+    """
+    выполнение обновления эвентов под блокировкой: вызовы, пришедшие во время уже идущего обновления,
+    не повторяют его, а дожидаются его окончания (не дольше, чем выдается блокировка) и возвращают его
+    результат
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        lease = getattr(settings, 'EVENTS_SYNC_LOCK_LEASE', 1800)
+        return call_single_flight(EVENTS_SYNC_LOCK, lease, func, *args, **kwargs)
+    return wrapper
+
+
+@events_sync
+def refresh_events_data(force=False, refresh_participants=False, refresh_for_events=(), stats=None, stream=None):
     """
     Обновление списка эвентов. Предполагается, что этот список меняется редко (или не меняется вообще).
     В процессе обновления эвент может быть удален, но только если он запланирован как минимум на следующий день.
+    Если передан stats (SyncStats), в нем будет посчитано количество добавленных/измененных записей.
+    При stream=True (по умолчанию берется из настройки ILE_SNAPSHOT_STREAMING) снэпшот разбирается
+    потоково, по одной активности, и в кеш не сохраняется.
+    Снэпшот запрашивается условно: если он не изменился с последней успешной обработки с обновлением
+    участников, база не затрагивается. При обработке снэпшота строится индекс эвентов, и отдельные эвенты без force
+    обновляются по данным из него без загрузки снэпшота (если эвента в индексе нет, снэпшот загружается).
+    Одновременно выполняется только одно обновление эвентов, остальные вызовы дожидаются его окончания
+    и возвращают его результат (см. events_sync).
     """
+    if stream is None:
+        stream = getattr(settings, 'ILE_SNAPSHOT_STREAMING', False)
+    api = Api()
+    # принудительное обновление всегда запрашивает свежие данные, индекс - только для обычного, а
+    # загруженные данные обновляют индекс, чтобы следующие обновления не откатили эвенты к старым
+    activities = get_indexed_activities(refresh_for_events) if refresh_for_events and not force else None
+    from_index = activities is not None
     try:
-        data, updated = Api().get_events_data(force=force)
+        if from_index:
+            updated = True
+        elif stream:
+            activities, updated = api.get_events_stream(conditional=not refresh_for_events)
+        else:
+            data, updated = api.get_events_data(force=force)
+            activities = (data or {}).get('activities') or []
     except ApiError:
         return
-    if not updated:
+    if not updated and not refresh_for_events:
         return True
     try:
         DEFAULT_CACHE.delete(EVENT_TYPES_CACHE_KEY)
-        event_types = {}
-        existing_uids = set(Event.objects.values_list('uid', flat=True))
-        fetched_events = set()
-        unti_id_to_user_id = dict(User.objects.values_list('unti_id', 'id'))
-        activities = data.get('activities') or []
-        filter_dict = lambda d, excl: {k: d.get(k) for k in d if k not in excl}
-        ACTIVITY_EXCLUDE_KEYS = ['runs', 'activity_type', 'rates']
-        RUN_EXCLUDE_KEYS = ['bets', 'assignments', 'events']
-        EVENT_EXCLUDE_KEYS = ['check_ins', 'time_slot']
-        for activity in activities:
-            title = activity.get('title', '')
-            runs = activity.get('runs') or []
-            event_type = None
-            activity_type = activity.get('activity_type')
-            activity_json = filter_dict(activity, ACTIVITY_EXCLUDE_KEYS)
-            if activity_type and activity_type.get('id'):
-                event_type = event_types.get(int(activity_type['id']))
-                if not event_type:
-                    event_type = EventType.objects.update_or_create(
-                        ext_id=int(activity_type['id']),
-                        defaults={'title': activity_type.get('title'),
-                                  'description': activity_type.get('description') or ''}
-                    )[0]
-            for run in runs:
-                run_json = filter_dict(run, RUN_EXCLUDE_KEYS)
-                events = run.get('events') or []
-                assignments = run.get('assignments') or []
-                participant_ids = []
-                for assignment in assignments:
-                    unti_id = (assignment.get('user') or {}).get('unti_id')
-                    if unti_id:
-                        participant_ids.append(int(unti_id))
-                for event in events:
-                    event_json = filter_dict(event, EVENT_EXCLUDE_KEYS)
-                    uid = event['uuid']
-                    if refresh_for_events and uid not in refresh_for_events:
-                        continue
-                    timeslot = event.get('time_slot')
-                    is_active = False if event.get('is_delete') else True
-                    dt_start, dt_end = datetime.now(), datetime.now()
-                    if timeslot:
-                        dt_start = parse_datetime(timeslot['time_start']) or datetime.now()
-                        dt_end = parse_datetime(timeslot['time_end']) or datetime.now()
-                    else:
-                        print(uid, title)
-                    e = Event.objects.update_or_create(uid=uid, defaults={
-                        'is_active': is_active,
-                        'ile_id': event.get('id'),
-                        'ext_id': event.get('ext_id'),
-                        'data': {'event': event_json, 'run': run_json, 'activity': activity_json},
-                        'dt_start': dt_start, 'dt_end': dt_end, 'title': title, 'event_type': event_type})[0]
-                    fetched_events.add(e.uid)
-                    if not refresh_participants:
-                        continue
-                    for ptcpt in participant_ids:
-                        user_id = unti_id_to_user_id.get(ptcpt)
-                        if not user_id:
-                            logging.error('User with unti_id %s not found' % ptcpt)
-                            continue
-                        EventEntry.all_objects.get_or_create(user_id=user_id, event_id=e.id)
-                    check_ins = event.get('check_ins') or []
-                    checked_users = []
-                    for check_in in check_ins:
-                        user_id = unti_id_to_user_id.get(int(check_in['user']['unti_id']))
-                        if not user_id:
-                            continue
-                        checked_users.append(user_id)
-                    EventEntry.all_objects.filter(event=e, added_by_assistant=False).update(is_active=False)
-                    EventEntry.all_objects.filter(event_id=e.id, user_id__in=checked_users).update(is_active=True)
-        if not refresh_for_events:
-            delete_events = existing_uids - fetched_events
-            Event.objects.filter(uid__in=delete_events).update(is_active=False)
-            # если произошли изменения в списке будущих эвентов
-            dt = timezone.now() + timezone.timedelta(days=1)
-            delete_qs = Event.objects.filter(uid__in=delete_events, dt_start__gt=dt)
-            delete_events = delete_qs.values_list('uid', flat=True)
-            if delete_events:
-                logging.warning('Event(s) with uuid: {} were deleted'.format(', '.join(delete_events)))
-                delete_qs.delete()
+        sync = EventsSync(refresh_participants=refresh_participants, refresh_for_events=refresh_for_events,
+                          stats=stats, build_index=not from_index)
+        for activity in timed(activities, 'decode'):
+            with phase('prepare'):
+                sync.add_activity(activity)
+        sync.finish()
+        # без обновления участников записи на эвенты не создаются, поэтому снэпшот не считается
+        # обработанным: иначе следующее полное обновление получило бы 304 и не создало бы записи
+        if not refresh_for_events and refresh_participants:
+            api.save_events_validators()
         return True
     except Exception:
         logging.exception('Failed to handle events data')
 
 
-def parse_activities(data, unti_id_to_user_id, fetched_events, event_types):
+def parse_activities(data, unti_id_to_user_id, fetched_events, event_types, catalog=None):
+    """
+    Обработка страницы активностей. Активности и прогоны страницы записываются пачкой через catalog,
+    эвенты обновляются по одному, а записи на них создаются для всей страницы сразу, после чего
+    для каждого эвента одним запросом проставляются чекины
+    """
     activities = data or []
+    catalog = catalog or ActivityCatalog()
+    entries, check_ins = set(), {}
     filter_dict = lambda d, excl: {k: d.get(k) for k in d if k not in excl}
     ACTIVITY_EXCLUDE_KEYS = ['runs', 'activity_type', 'rates']
     RUN_EXCLUDE_KEYS = ['bets', 'assignments', 'events']
     EVENT_EXCLUDE_KEYS = ['check_ins', 'time_slot']
+    refs = []
     for activity in activities:
+        activity_ext_id = catalog.add_activity(filter_dict(activity, ACTIVITY_EXCLUDE_KEYS))
+        refs.append((activity_ext_id, [catalog.add_run(filter_dict(run, RUN_EXCLUDE_KEYS), activity_ext_id)
+                                       for run in activity.get('runs') or []]))
+    catalog.flush()
+    for activity, (activity_ext_id, run_ext_ids) in zip(activities, refs):
         title = activity.get('title', '')
         runs = activity.get('runs') or []
         event_type = None
@@ -137,7 +129,8 @@ def parse_activities(data, unti_id_to_user_id, fetched_events, event_types):
                     defaults={'title': activity_type.get('title'),
                               'description': activity_type.get('description') or ''}
                 )[0]
-        for run in runs:
+                event_types[event_type.ext_id] = event_type
+        for run, run_ext_id in zip(runs, run_ext_ids):
             run_json = filter_dict(run, RUN_EXCLUDE_KEYS)
             events = run.get('events') or []
             assignments = run.get('assignments') or []
@@ -159,95 +152,284 @@ def parse_activities(data, unti_id_to_user_id, fetched_events, event_types):
                     'is_active': is_active,
                     'ile_id': event.get('id'),
                     'ext_id': event.get('ext_id'),
-                    'data': {'event': event_json, 'run': run_json, 'activity': activity_json},
-                    'dt_start': dt_start, 'dt_end': dt_end, 'title': title, 'event_type': event_type})[0]
+                    'data': get_event_data(event_json, run_json, activity_json, run_ext_id, activity_ext_id),
+                    'dt_start': dt_start, 'dt_end': dt_end, 'title': title, 'event_type': event_type,
+                    'activity_id': catalog.get_activity_id(activity_ext_id),
+                    'run_id': catalog.get_run_id(run_ext_id),
+                    'activity_ext_id': activity_ext_id, 'run_ext_id': get_ext_id(run_json),
+                    'authors': get_authors(activity_json)})[0]
                 fetched_events.add(e.uid)
                 for ptcpt in participant_ids:
                     user_id = unti_id_to_user_id.get(ptcpt)
                     if not user_id:
                         logging.error('User with unti_id %s not found' % ptcpt)
                         continue
-                    EventEntry.all_objects.get_or_create(user_id=user_id, event_id=e.id)
-                check_ins = event.get('check_ins') or []
-                checked_users = []
-                for check_in in check_ins:
-                    user_id = unti_id_to_user_id.get(int(check_in['user']['unti_id']))
-                    if not user_id:
-                        continue
-                    checked_users.append(user_id)
-                EventEntry.all_objects.filter(event=e, added_by_assistant=False).update(is_active=False)
-                EventEntry.all_objects.filter(event_id=e.id, user_id__in=checked_users).update(is_active=True)
+                    entries.add((e.id, user_id))
+                check_ins[e.id] = get_checked_user_ids(event.get('check_ins') or [], unti_id_to_user_id)
+    with phase('entries'):
+        reconcile_event_entries(entries)
+    with phase('check_ins'):
+        for event_id, checked in check_ins.items():
+            set_event_check_ins(event_id, checked)
+
+
+def iter_activity_pages(concurrency=None, start_page=1, updated_since=None):
+    """
+    Постраничное получение активностей (при указании updated_since - только измененных с этого
+    момента) начиная со страницы start_page с упреждающей загрузкой:
+    одновременно запрашивается до concurrency страниц (по умолчанию ACTIVITIES_PREFETCH_PAGES), пока
+    предыдущие обрабатываются, а отдаются страницы по порядку. Итерация заканчивается на первой
+    несуществующей странице.
+    """
+    concurrency = max(concurrency or getattr(settings, 'ACTIVITIES_PREFETCH_PAGES', 1), 1)
+    api = Api()
+    if not api.token:
+        # получаем токен заранее, чтобы его не запрашивал каждый поток
+        api.refresh_token()
+    futures = deque()
+    next_page = start_page
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        try:
+            while True:
+                while len(futures) < concurrency:
+                    futures.append(executor.submit(api.get_paginated_activities, next_page, updated_since))
+                    next_page += 1
+                try:
+                    data = futures.popleft().result()
+                except ApiNotFound:
+                    return
+                yield data
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def get_sync_checkpoint(name):
+    """
+    незавершенная синхронизация name, если она начата не раньше SYNC_CHECKPOINT_MAX_AGE секунд назад
+    (более старую продолжать нет смысла), иначе новая
+    """
+    dt = timezone.now() - timezone.timedelta(seconds=getattr(settings, 'SYNC_CHECKPOINT_MAX_AGE', 86400))
+    SyncCheckpoint.objects.filter(name=name, started_on__lt=dt).delete()
+    return SyncCheckpoint.objects.filter(name=name).first() or SyncCheckpoint(name=name, started_on=timezone.now())
+
+
+def save_sync_checkpoint(checkpoint, page, fetched_events):
+    checkpoint.page = page
+    checkpoint.fetched_uids = sorted(fetched_events)
+    checkpoint.save()
+
+
+@events_sync
+def refresh_events_data_v2(full=False):
+    """
+    Постраничное обновление эвентов. Обычно запрашиваются только активности, измененные с начала
+    прошлого успешного обновления (за вычетом ILE_UPDATED_SINCE_OVERLAP секунд). Полное обновление
+    выполняется при full=True, если прошлого обновления не было или с прошлого полного прошло больше
+    ILE_FULL_SYNC_INTERVAL секунд, а также если есть незавершенное полное обновление.
+    Состояние полного обновления сохраняется каждые SYNC_CHECKPOINT_EVERY страниц и при ошибке,
+    и следующий запуск продолжает его с того места, где оно остановилось. Эвенты, пропавшие из ILE,
+    удаляются только после того, как при полном обновлении получены все страницы.
+    """
+    started_on = timezone.now()
+    watermark = DEFAULT_CACHE.get(ACTIVITIES_WATERMARK_CACHE_KEY)
+    last_full = DEFAULT_CACHE.get(ACTIVITIES_FULL_SYNC_CACHE_KEY)
+    checkpoint = get_sync_checkpoint(V2_SYNC_CHECKPOINT)
+    full_interval = timezone.timedelta(seconds=getattr(settings, 'ILE_FULL_SYNC_INTERVAL', 86400))
+    full = full or watermark is None or last_full is None or started_on - last_full > full_interval \
+        or checkpoint.pk is not None
+    if full:
+        success = sync_all_activities(checkpoint)
+    else:
+        since = watermark - timezone.timedelta(seconds=getattr(settings, 'ILE_UPDATED_SINCE_OVERLAP', 300))
+        success = sync_updated_activities(since)
+    if success:
+        # полное обновление могло начаться в одном из прошлых запусков
+        if full:
+            started_on = min(started_on, checkpoint.started_on)
+            DEFAULT_CACHE.set(ACTIVITIES_FULL_SYNC_CACHE_KEY, started_on, timeout=None)
+        DEFAULT_CACHE.set(ACTIVITIES_WATERMARK_CACHE_KEY, started_on, timeout=None)
+    return success
+
+
+def sync_updated_activities(since):
+    """
+    обновление эвентов активностей, измененных с момента since
+    """
+    unti_id_to_user_id = dict(User.objects.values_list('unti_id', 'id'))
+    event_types = {}
+    catalog = ActivityCatalog()
+    try:
+        for data in timed(iter_activity_pages(updated_since=since), 'download'):
+            with phase('events'):
+                parse_activities(data, unti_id_to_user_id, set(), event_types, catalog)
+    except ApiError:
+        return False
+    except Exception:
+        logging.exception('Failed to handle events data')
+        return False
+    return True
 
 
-def refresh_events_data_v2():
-    page = 1
+def sync_all_activities(checkpoint):
+    """
+    полное обновление эвентов с продолжением с сохраненной страницы и удалением пропавших эвентов
+    """
+    page = checkpoint.page
+    if page:
+        logging.warning('Resuming events sync started at %s from page %s' % (checkpoint.started_on, page + 1))
+    checkpoint_every = max(getattr(settings, 'SYNC_CHECKPOINT_EVERY', 10), 1)
     existing_uids = set(Event.objects.values_list('uid', flat=True))
     unti_id_to_user_id = dict(User.objects.values_list('unti_id', 'id'))
-    fetched_events = set()
+    fetched_events = set(checkpoint.fetched_uids)
     event_types = {}
-    while True:
-        try:
-            data = Api().get_paginated_activities(page)
-            parse_activities(data, unti_id_to_user_id, fetched_events, event_types)
+    catalog = ActivityCatalog()
+    try:
+        for data in timed(iter_activity_pages(start_page=page + 1), 'download'):
+            with phase('events'):
+                parse_activities(data, unti_id_to_user_id, fetched_events, event_types, catalog)
             page += 1
-        except ApiNotFound:
-            delete_events = existing_uids - fetched_events
-            # если произошли изменения в списке будущих эвентов
-            dt = timezone.now() + timezone.timedelta(days=1)
-            delete_qs = Event.objects.filter(uid__in=delete_events, dt_start__gt=dt)
-            delete_events = delete_qs.values_list('uid', flat=True)
-            if delete_events:
-                logging.warning('Event(s) with uuid: {} were deleted'.format(', '.join(delete_events)))
-                delete_qs.delete()
-            return True
-        except ApiError:
-            return False
-        except Exception:
-            logging.exception('Failed to handle events data')
-            return False
-
-
-def update_events_traces():
-    """
-    обновление трейсов по всем эвентам
-    """
-    events = {e.uid: e for e in Event.objects.all()}
+            if page % checkpoint_every == 0:
+                save_sync_checkpoint(checkpoint, page, fetched_events)
+    except ApiError:
+        save_sync_checkpoint(checkpoint, page, fetched_events)
+        return False
+    except Exception:
+        logging.exception('Failed to handle events data')
+        save_sync_checkpoint(checkpoint, page, fetched_events)
+        return False
+    delete_events = existing_uids - fetched_events
+    # если произошли изменения в списке будущих эвентов
+    dt = timezone.now() + timezone.timedelta(days=1)
+    delete_qs = Event.objects.filter(uid__in=delete_events, dt_start__gt=dt)
+    delete_events = delete_qs.values_list('uid', flat=True)
+    if delete_events:
+        logging.warning('Event(s) with uuid: {} were deleted'.format(', '.join(delete_events)))
+        delete_qs.delete()
+    if checkpoint.pk:
+        checkpoint.delete()
+    return True
+
+
+def get_events_version():
+    """
+    версия набора эвентов: меняется при создании и удалении эвентов
+    """
+    data = Event.objects.aggregate(count=Count('id'), last_id=Max('id'))
+    return [data['count'], data['last_id']]
+
+
+def update_events_traces(stats=None):
+    """
+    обновление трейсов по всем эвентам. Запрос к LABS делается условным, и если ни трейсы, ни набор
+    эвентов не изменились с последнего успешного обновления, база не затрагивается
+    """
     try:
-        resp = requests.get(settings.LABS_TRACES_API_URL, timeout=settings.CONNECTION_TIMEOUT)
+        events_version = get_events_version()
+        headers = {}
+        # трейсы привязываются к эвентам по uid, поэтому при появлении новых эвентов трейсы надо
+        # перепривязать, даже если сами они не изменились
+        if (DEFAULT_CACHE.get(LABS_TRACES_VALIDATORS_CACHE_KEY) or {}).get('events') == events_version:
+            headers = get_conditional_headers(LABS_TRACES_VALIDATORS_CACHE_KEY)
+        with phase('traces_download'):
+            resp = send_request('get', settings.LABS_TRACES_API_URL, timeout=settings.CONNECTION_TIMEOUT,
+                                headers=headers)
+        if resp.status_code == 304:
+            return
         assert resp.ok
-        for trace in resp.json():
-            t = Trace.objects.update_or_create(
-                ext_id=trace['id'], defaults={'trace_type': trace['title'], 'name': trace['description']}
-            )[0]
-            trace_events = list(filter(None, [events.get(uid) for uid in trace.get('events', [])]))
-            # test_e = Event.objects.get(uid='b94f4320-8111-4f37-95cb-a7d4f10a1ae6')
-            # if not trace_events:
-            #     trace_events = [test_e]
-            t.events.set(trace_events)
+        with phase('traces'):
+            sync_traces(resp.json(), stats=stats)
+        save_validators(LABS_TRACES_VALIDATORS_CACHE_KEY, dict(get_validators(resp), events=events_version))
     except Exception:
         logging.exception('failed to update traces')
 
 
+def get_checked_user_ids(check_ins, unti_id_to_user_id):
+    checked = set()
+    for check_in in check_ins:
+        user_id = unti_id_to_user_id.get(int(check_in['user']['unti_id']))
+        if user_id:
+            checked.add(user_id)
+    return checked
+
+
+def set_event_check_ins(event_id, checked):
+    """
+    проставление чекинов эвента одним запросом: записи пользователей из checked становятся активными,
+    остальные записи, добавленные не ассистентом, - неактивными. Затрагиваются только записи,
+    у которых флаг меняется
+    """
+    checked = list(checked)
+    activate = Q(user_id__in=checked, is_active=False)
+    deactivate = Q(added_by_assistant=False, is_active=True) & ~Q(user_id__in=checked)
+    return EventEntry.all_objects.filter(Q(event_id=event_id) & (activate | deactivate)).update(
+        is_active=Case(When(user_id__in=checked, then=Value(True)), default=Value(False),
+                       output_field=BooleanField())
+    )
+
+
 def update_check_ins_for_event(event):
     try:
         data = Api().get_check_ins_data(event.ile_id)
         unti_id_to_user_id = dict(User.objects.values_list('unti_id', 'id'))
-        checked = []
-        for check_in in data:
-            user_id = unti_id_to_user_id.get(int(check_in['user']['unti_id']))
-            if not user_id:
-                continue
-            checked.append(user_id)
-        EventEntry.all_objects.filter(event_id=event.id, added_by_assistant=False).update(is_active=False)
-        EventEntry.all_objects.filter(event_id=event.id, user_id__in=checked).update(is_active=True)
+        set_event_check_ins(event.id, get_checked_user_ids(data, unti_id_to_user_id))
         return True
     except ApiError:
         return False
 
 
-def set_check_in(event, user, confirmed):
+def get_active_events(date_from, date_to):
+    """
+    эвенты, доступные для оцифровки и отображаемые на главной, которые начинаются в дни с date_from
+    по date_to включительно (None - без ограничения с этой стороны)
+    """
+    events = Event.objects.filter(is_active=True)
+    if date_from:
+        events = events.filter(dt_start__gte=timezone.make_aware(datetime.combine(date_from, datetime.min.time())))
+    if date_to:
+        max_dt = timezone.make_aware(datetime.combine(date_to, datetime.min.time())) + timezone.timedelta(days=1)
+        events = events.filter(dt_start__lt=max_dt)
+    if settings.VISIBLE_EVENT_TYPES:
+        events = events.filter(event_type_id__in=get_allowed_event_type_ids())
+    return events
+
+
+def update_check_ins_for_events(events, workers=None):
+    """
+    Обновление чекинов сразу для нескольких эвентов: списки чекинов запрашиваются из ILE параллельно,
+    не более workers запросов одновременно (по умолчанию CHECK_INS_REFRESH_WORKERS), а записи каждого
+    эвента обновляются одним запросом по мере получения ответов. Возвращает количество эвентов,
+    для которых чекины обновлены
+    """
+    events = [e for e in events if e.ile_id]
+    if not events:
+        return 0
+    workers = max(workers or getattr(settings, 'CHECK_INS_REFRESH_WORKERS', 1), 1)
+    api = Api()
+    try:
+        if not api.token:
+            api.refresh_token()
+    except ApiError:
+        return 0
+    unti_id_to_user_id = dict(User.objects.values_list('unti_id', 'id'))
+    updated = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(api.get_check_ins_data, e.ile_id): e for e in events}
+        for future in as_completed(futures):
+            event = futures[future]
+            try:
+                data = future.result()
+            except ApiError:
+                logging.error('Failed to get check ins for event %s' % event.uid)
+                continue
+            set_event_check_ins(event.id, get_checked_user_ids(data, unti_id_to_user_id))
+            updated += 1
+    return updated
+
+
+def set_check_in(event, user, confirmed, api=None):
     try:
-        Api().set_check_in(event.ext_id, user.unti_id, confirmed)
+        (api or Api()).set_check_in(event.ext_id, user.unti_id, confirmed)
         return True
     except ApiError:
         return False
@@ -7,7 +7,7 @@ from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.views import logout as base_logout
 from django.core.exceptions import PermissionDenied
-from django.db.models import Count, Q
+from django.db.models import Count, Exists, OuterRef, Q, Sum
 from django.http import HttpResponseForbidden, JsonResponse, HttpResponseRedirect
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
@@ -22,11 +22,15 @@ from rest_framework.pagination import PageNumberPagination
 from rest_framework.permissions import BasePermission
 from rest_framework.response import Response
 from social_django.models import UserSocialAuth
+from isle.db import count_subquery, update_entry_counts
 from isle.forms import CreateTeamForm, AddUserForm
+from isle.jobs import enqueue_refresh
 from isle.models import Event, EventEntry, EventMaterial, User, Trace, Team, EventTeamMaterial, EventOnlyMaterial, \
-    Attendance
+    Attendance, MaterialCounter, SyncJob
 from isle.serializers import AttendanceSerializer
-from isle.utils import refresh_events_data, get_allowed_event_type_ids, update_check_ins_for_event, set_check_in
+from isle.traces import get_trace_catalog
+from isle.utils import get_allowed_event_type_ids, update_check_ins_for_event, set_check_in, \
+    get_active_events, update_check_ins_for_events
 
 
 def login(request):
@@ -37,50 +41,85 @@ def logout(request):
     return base_logout(request, next_page='index')
 
 
+class DatePeriodMixin:
+    """
+    выбор дня (параметр date) или периода (date_from и/или date_to) из запроса. Если не задано
+    ни то, ни другое, ассистенту выбирается текущий день
+    """
+    DATE_FORMAT = '%Y-%m-%d'
+
+    def parse_date(self, param):
+        try:
+            return timezone.datetime.strptime(self.request.GET.get(param), self.DATE_FORMAT).date()
+        except (TypeError, ValueError):
+            return
+
+    def get_date(self):
+        date = self.parse_date('date')
+        if date is None and self.request.user.is_assistant and not self.is_period():
+            date = timezone.localtime(timezone.now()).date()
+        return date
+
+    def is_period(self):
+        return self.parse_date('date_from') is not None or self.parse_date('date_to') is not None
+
+    def get_period(self):
+        """
+        первый и последний день выбранного периода, None - период не ограничен с этой стороны
+        """
+        date = self.get_date()
+        if date:
+            return date, date
+        return self.parse_date('date_from'), self.parse_date('date_to')
+
+    @staticmethod
+    def day_start(date):
+        return timezone.make_aware(timezone.datetime.combine(date, timezone.datetime.min.time()))
+
+
 @method_decorator(login_required, name='dispatch')
-class Index(TemplateView):
+class Index(DatePeriodMixin, TemplateView):
     """
-    все эвенты (доступные пользователю)
+    все эвенты (доступные пользователю) за день или период, постранично. Страницы задаются курсором
+    after - временем начала и id последнего эвента предыдущей страницы, поэтому стоимость страницы
+    не зависит от ее номера
     """
     template_name = 'index.html'
-    DATE_FORMAT = '%Y-%m-%d'
+    EPOCH = timezone.make_aware(timezone.datetime(1970, 1, 1), timezone.utc)
 
     def get_context_data(self, **kwargs):
         date = self.get_date()
-        objects = self.get_events()
+        objects, next_cursor = self.get_page(self.get_events())
+        ids = [obj.id for obj in objects]
         ctx = {
             'objects': objects,
             'date': date.strftime(self.DATE_FORMAT) if date else None,
+            'date_from': self.request.GET.get('date_from') or '',
+            'date_to': self.request.GET.get('date_to') or '',
             'sort_asc': self.is_asc_sort(),
+            'next_url': self.get_page_url(next_cursor) if next_cursor else None,
+            'first_url': self.get_page_url(None) if self.request.GET.get('after') else None,
         }
         if self.request.user.is_assistant:
-            fdict = {
-                'initiator__in': User.objects.filter(is_assistant=True).values_list('id', flat=True)
-            }
-            ctx.update({
-                'total_elements': EventMaterial.objects.count() +
-                                  EventTeamMaterial.objects.count() +
-                                  EventOnlyMaterial.objects.count(),
-                'today_elements': EventMaterial.objects.filter(event__in=objects).count() +
-                                  EventTeamMaterial.objects.filter(event__in=objects).count() +
-                                  EventOnlyMaterial.objects.filter(event__in=objects).count(),
-                'total_elements_user': EventMaterial.objects.exclude(initiator__isnull=True).exclude(**fdict).count() +
-                                       EventTeamMaterial.objects.exclude(initiator__isnull=True).exclude(**fdict).count(),
-                'today_elements_user': EventMaterial.objects.exclude(initiator__isnull=True).exclude(**fdict).filter(event__in=objects).count() +
-                                       EventTeamMaterial.objects.exclude(initiator__isnull=True).exclude(**fdict).filter(event__in=objects).count(),
-            })
+            in_objects = Q(event_id__in=ids)
+            counters = MaterialCounter.objects.aggregate(
+                total_elements=Sum('num'),
+                today_elements=Sum('num', filter=in_objects),
+                total_elements_user=Sum('num', filter=Q(is_user=True)),
+                today_elements_user=Sum('num', filter=in_objects & Q(is_user=True)),
+            )
+            ctx.update({k: v or 0 for k, v in counters.items()})
             if self.request.user.is_assistant:
-                enrollments = dict(EventEntry.objects.values_list('event_id').annotate(cnt=Count('user_id')))
-                check_ins = dict(EventEntry.objects.filter(is_active=True).values_list('event_id')
+                check_ins = dict(EventEntry.objects.filter(event_id__in=ids, is_active=True).values_list('event_id')
                                  .annotate(cnt=Count('user_id')))
                 for obj in objects:
-                    obj.prop_enrollments = enrollments.get(obj.id, 0)
+                    obj.prop_enrollments = obj.entry_count
                     obj.prop_checkins = check_ins.get(obj.id, 0)
         else:
-            user_materials_num = dict(EventMaterial.objects.filter(event__in=objects, user=self.request.user)
+            user_materials_num = dict(EventMaterial.objects.filter(event_id__in=ids, user=self.request.user)
                                       .values_list('event_id').annotate(cnt=Count('user_id')))
-            teams = Team.objects.filter(event__in=objects, users=self.request.user).values_list('id', flat=True)
-            team_materials_num = dict(EventTeamMaterial.objects.filter(event__in=objects, team_id__in=teams)
+            teams = Team.objects.filter(event_id__in=ids, users=self.request.user).values_list('id', flat=True)
+            team_materials_num = dict(EventTeamMaterial.objects.filter(event_id__in=ids, team_id__in=teams)
                                       .values_list('event_id').annotate(cnt=Count('team_id')))
             event_num, trace_num = 0, 0
             for obj in objects:
@@ -92,15 +131,6 @@ class Index(TemplateView):
             ctx.update({'event_num': event_num, 'trace_num': trace_num})
         return ctx
 
-    def get_date(self):
-        try:
-            date = timezone.datetime.strptime(self.request.GET.get('date'), self.DATE_FORMAT).date()
-        except:
-            if not self.request.user.is_assistant:
-                return
-            date = timezone.localtime(timezone.now()).date()
-        return date
-
     def get_events(self):
         if self.request.user.is_assistant:
             events = Event.objects.filter(is_active=True)
@@ -109,13 +139,46 @@ class Index(TemplateView):
                                           values_list('event_id', flat=True))
         if settings.VISIBLE_EVENT_TYPES:
             events = events.filter(event_type_id__in=get_allowed_event_type_ids())
-        date = self.get_date()
-        if date:
-            min_dt = timezone.make_aware(timezone.datetime.combine(date, timezone.datetime.min.time()))
-            max_dt = min_dt + timezone.timedelta(days=1)
-            events = events.filter(dt_start__gte=min_dt, dt_start__lt=max_dt)
-        events = events.order_by('{}dt_start'.format('' if self.is_asc_sort() else '-'))
-        return events
+        date_from, date_to = self.get_period()
+        if date_from:
+            events = events.filter(dt_start__gte=self.day_start(date_from))
+        if date_to:
+            events = events.filter(dt_start__lt=self.day_start(date_to) + timezone.timedelta(days=1))
+        prefix = '' if self.is_asc_sort() else '-'
+        return events.defer('data').order_by('{}dt_start'.format(prefix), '{}id'.format(prefix))
+
+    def get_page(self, events):
+        """
+        страница эвентов после курсора из запроса и курсор следующей страницы (None, если ее нет)
+        """
+        cursor = self.parse_cursor(self.request.GET.get('after'))
+        if cursor:
+            dt, pk = cursor
+            if self.is_asc_sort():
+                events = events.filter(Q(dt_start__gt=dt) | Q(dt_start=dt, id__gt=pk))
+            else:
+                events = events.filter(Q(dt_start__lt=dt) | Q(dt_start=dt, id__lt=pk))
+        page_size = getattr(settings, 'INDEX_EVENTS_PAGE_SIZE', 100)
+        objects = list(events[:page_size + 1])
+        if len(objects) <= page_size:
+            return objects, None
+        objects = objects[:page_size]
+        last = objects[-1]
+        return objects, '%d_%d' % ((last.dt_start - self.EPOCH) // timezone.timedelta(microseconds=1), last.id)
+
+    def parse_cursor(self, value):
+        try:
+            micro, pk = map(int, (value or '').split('_'))
+        except ValueError:
+            return
+        return self.EPOCH + timezone.timedelta(microseconds=micro), pk
+
+    def get_page_url(self, cursor):
+        params = self.request.GET.copy()
+        params.pop('after', None)
+        if cursor:
+            params['after'] = cursor
+        return '{}?{}'.format(reverse('index'), params.urlencode())
 
     def is_asc_sort(self):
         return self.request.GET.get('sort') != 'desc'
@@ -148,6 +211,23 @@ def get_event_participants(event):
     return User.objects.filter(id__in=users).order_by('last_name', 'first_name', 'second_name')
 
 
+def get_event_roster(event, user):
+    """
+    записи участников эвента вместе с пользователями и признаками для страницы эвента одним запросом:
+    attend - присутствие подтверждено, added_by_chat_bot - присутствие отмечено чат-ботом,
+    materials_num - количество материалов участника, видимых пользователю user
+    """
+    attendances = Attendance.objects.filter(event=event, user=OuterRef('user_id'))
+    materials = EventMaterial.objects.filter(event=event)
+    if not user.is_assistant:
+        materials = materials.filter(Q(is_public=True) | Q(user=user))
+    return EventEntry.objects.filter(event=event).select_related('user').annotate(
+        attend=Exists(attendances.filter(is_confirmed=True)),
+        added_by_chat_bot=Exists(attendances.filter(confirmed_by_system=Attendance.SYSTEM_CHAT_BOT)),
+        materials_num=count_subquery(materials, 'user', 'user_id'),
+    ).order_by('user__last_name', 'user__first_name', 'user__second_name')
+
+
 class EventView(GetEventMixinWithAccessCheck, TemplateView):
     """
     Просмотр статистики загрузок материалов по эвентам
@@ -155,37 +235,29 @@ class EventView(GetEventMixinWithAccessCheck, TemplateView):
     template_name = 'event_view.html'
 
     def get_context_data(self, **kwargs):
-        users = list(get_event_participants(self.event))
-        user_entry = [i for i in users if i.id == self.request.user.id]
-        if user_entry:
-            users = user_entry + [i for i in users if i.id != self.request.user.id]
-        check_ins = set(EventEntry.objects.filter(event=self.event, is_active=True).values_list('user_id', flat=True))
-        attends = set(Attendance.objects.filter(event=self.event, is_confirmed=True).values_list('user_id', flat=True))
-        chat_bot_added = set(Attendance.objects.filter(event=self.event, confirmed_by_system=Attendance.SYSTEM_CHAT_BOT)
-                             .values_list('user_id', flat=True))
+        entries = list(get_event_roster(self.event, self.request.user))
+        event_entry = next((i for i in entries if i.user_id == self.request.user.id), None)
+        if event_entry is not None:
+            entries = [event_entry] + [i for i in entries if i is not event_entry]
+        users = []
+        for entry in entries:
+            u = entry.user
+            u.materials_num = entry.materials_num
+            u.checked_in = entry.is_active
+            u.attend = entry.attend
+            u.can_delete = entry.added_by_assistant
+            u.added_by_chat_bot = entry.added_by_chat_bot
+            users.append(u)
         user_teams = []
         if not self.request.user.is_assistant:
-            num = dict(EventMaterial.objects.filter(event=self.event, user__in=users, is_public=True).
-                       values_list('user_id').annotate(num=Count('event_id')))
-            num[self.request.user.id] = EventMaterial.objects.filter(event=self.event, user=self.request.user).count()
             user_teams = list(Team.objects.filter(event=self.event, users=self.request.user).values_list('id', flat=True))
-        else:
-            num = dict(EventMaterial.objects.filter(event=self.event, user__in=users).
-                       values_list('user_id').annotate(num=Count('event_id')))
-        can_delete = set(EventEntry.objects.filter(event=self.event, added_by_assistant=True).
-                         values_list('user_id', flat=True))
-        for u in users:
-            u.materials_num = num.get(u.id, 0)
-            u.checked_in = u.id in check_ins
-            u.attend = u.id in attends
-            u.can_delete = u.id in can_delete
-            u.added_by_chat_bot = u.id in chat_bot_added
         return {
             'students': users,
             'event': self.event,
-            'teams': Team.objects.filter(event=self.event).select_related('creator').order_by('name'),
+            'teams': Team.objects.filter(event=self.event).select_related('creator').annotate(
+                users_num=Count('users')).order_by('name'),
             'user_teams': user_teams,
-            'event_entry': EventEntry.objects.filter(event=self.event, user=self.request.user).first(),
+            'event_entry': event_entry,
         }
 
 
@@ -213,7 +285,7 @@ class BaseLoadMaterials(GetEventMixinWithAccessCheck, TemplateView):
         return False
 
     def get_traces_data(self):
-        traces = self.event.get_traces()
+        traces = get_trace_catalog(self.event)
         result = []
         links = defaultdict(list)
         for item in self.get_materials():
@@ -230,7 +302,7 @@ class BaseLoadMaterials(GetEventMixinWithAccessCheck, TemplateView):
             trace_id = int(request.POST.get('trace_name'))
         except (ValueError, TypeError):
             return JsonResponse({}, status=400)
-        if not trace_id or not trace_id in [i.id for i in self.event.get_traces()]:
+        if not trace_id or trace_id not in get_trace_catalog(self.event):
             return JsonResponse({}, status=400)
         if 'add_btn' in request.POST:
             return self.add_item(request)
@@ -377,7 +449,7 @@ class LoadTeamMaterials(BaseLoadMaterials):
             trace_id = int(request.POST.get('trace_name'))
         except (ValueError, TypeError):
             return JsonResponse({}, status=400)
-        if not trace_id or not trace_id in [i.id for i in self.event.get_traces()]:
+        if not trace_id or trace_id not in get_trace_catalog(self.event):
             return JsonResponse({}, status=400)
         if 'add_btn' in request.POST:
             return self.add_item(request)
@@ -444,18 +516,26 @@ class LoadEventMaterials(BaseLoadMaterials):
 
 
 class RefreshDataView(View):
+    """
+    постановка задачи на обновление данных в очередь фонового обработчика. Возвращает id задачи
+    и урл, по которому можно узнать ее статус
+    """
     def get(self, request, uid=None):
-        if not request.user.is_assistant:
-            success = False
-        else:
-            if uid:
-                if not Event.objects.filter(uid=uid).exists():
-                    success = False
-                else:
-                    success = refresh_events_data(force=True, refresh_participants=True, refresh_for_events=[uid])
-            else:
-                success = refresh_events_data(force=True)
-        return JsonResponse({'success': bool(success)})
+        if not request.user.is_authenticated or not request.user.is_assistant or \
+                (uid and not Event.objects.filter(uid=uid).exists()):
+            return JsonResponse({'success': False})
+        job = enqueue_refresh(uid)
+        return JsonResponse({'success': True, 'job_id': job.id, 'status': job.status,
+                             'status_url': reverse('refresh-status-view', kwargs={'job_id': job.id})})
+
+
+class RefreshStatusView(View):
+    def get(self, request, job_id=None):
+        if not request.user.is_authenticated or not request.user.is_assistant:
+            return JsonResponse({'success': False})
+        job = get_object_or_404(SyncJob, id=job_id)
+        return JsonResponse({'success': job.status != SyncJob.STATUS_FAILED, 'status': job.status,
+                             'finished': job.is_finished})
 
 
 class CreateTeamView(GetEventMixin, TemplateView):
@@ -524,6 +604,24 @@ class RefreshCheckInView(GetEventMixin, View):
     #     return JsonResponse({'success': result})
 
 
+class RefreshCheckInsView(DatePeriodMixin, View):
+    """
+    Обновление из ILE чекинов всех доступных для оцифровки мероприятий выбранного дня или периода
+    (параметры те же, что и у списка эвентов). Чекины обновляются в запросе, поэтому период должен быть
+    ограничен с обеих сторон и не длиннее CHECK_INS_REFRESH_MAX_DAYS дней
+    """
+    def get(self, request):
+        if not request.user.is_authenticated or not request.user.is_assistant:
+            return HttpResponseForbidden()
+        date_from, date_to = self.get_period()
+        max_days = getattr(settings, 'CHECK_INS_REFRESH_MAX_DAYS', 7)
+        if not date_from or not date_to or not 0 <= (date_to - date_from).days < max_days:
+            return JsonResponse({'error': 'Выберите период не длиннее %s дн.' % max_days}, status=400)
+        events = list(get_active_events(date_from, date_to).only('id', 'uid', 'ile_id', 'ext_id'))
+        updated = update_check_ins_for_events(events)
+        return JsonResponse({'success': bool(updated) or not events, 'updated': updated})
+
+
 class AddUserToEvent(GetEventMixin, TemplateView):
     """
     Добавить пользователя на мероприятие вручную
@@ -572,6 +670,7 @@ class RemoveUserFromEvent(GetEventMixin, View):
         except (TypeError, ValueError, EventEntry.DoesNotExist):
             return JsonResponse({}, status=404)
         EventEntry.objects.filter(event=self.event, user_id=request.POST.get('user_id')).update(deleted=True)
+        update_entry_counts([self.event.id])
         Attendance.objects.filter(event=self.event, user_id=request.POST.get('user_id')).delete()
         logging.warning('User %s removed user %s from event %s' %
                         (request.user.username, entry.user.username, entry.event.uid))
@@ -690,7 +789,7 @@ class AttendanceApi(ListAPIView):
     permission_classes = (ApiPermission, )
 
     def get_queryset(self):
-        qs = Attendance.objects.order_by('id')
+        qs = Attendance.objects.select_related('event').defer('event__data').order_by('id')
         unti_id = self.request.query_params.get('unti_id')
         if unti_id and unti_id.isdigit():
             qs = qs.filter(user__unti_id=unti_id)
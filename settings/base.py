@@ -74,6 +74,21 @@ DATABASES = {
     }
 }
 
+# Caches
+# https://docs.djangoproject.com/en/2.0/ref/settings/#caches
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # индекс эвентов снэпшота хранит по записи на эвент и не должен вытеснять записи основного кеша
+    'events_index': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'events_index',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
@@ -137,8 +152,62 @@ VISIBLE_EVENT_TYPES = ['клуб мышления', 'визионерская л
 MAX_PARALLEL_UPLOADS = 10
 # использовать снэпшот для обновления эвентов
 USE_ILE_SNAPSHOT = True
+# разбирать снэпшот потоково, по одной активности, не загружая его в память целиком
+ILE_SNAPSHOT_STREAMING = True
 # сколько активностей запрашивать на странице (если не используется снэпшот для обновления эвентов)
 ACTIVITIES_PER_PAGE = 20
+# сколько страниц активностей запрашивать одновременно (если не используется снэпшот для обновления эвентов)
+ACTIVITIES_PREFETCH_PAGES = 4
+# через сколько страниц активностей сохранять состояние постраничного обновления эвентов, чтобы после
+# ошибки продолжить с того же места, и через сколько секунд незавершенное обновление начинать заново
+SYNC_CHECKPOINT_EVERY = 10
+SYNC_CHECKPOINT_MAX_AGE = 60 * 60 * 24
+# постраничное обновление эвентов запрашивает только активности, измененные с прошлого обновления: имя
+# параметра запроса к ILE, запас по времени в секундах на расхождение часов и как часто выполнять полное
+# обновление (с удалением пропавших эвентов)
+ILE_UPDATED_SINCE_PARAM = 'updated_since'
+ILE_UPDATED_SINCE_OVERLAP = 300
+ILE_FULL_SYNC_INTERVAL = 60 * 60 * 24
+# сколько запросов чекинов эвентов делать одновременно при обновлении чекинов за несколько дней
+CHECK_INS_REFRESH_WORKERS = 8
+# максимальная длина периода в днях, за который можно обновить чекины кнопкой на главной
+CHECK_INS_REFRESH_MAX_DAYS = 7
+# количество хостов и keep-alive соединений на хост в пуле http-соединений
+ILE_POOL_CONNECTIONS = 4
+ILE_POOL_MAXSIZE = 10
+# количество повторов запроса при ошибке соединения или ответе 5xx, базовая и максимальная пауза
+# между повторами в секундах (пауза растет экспоненциально, со случайным разбросом)
+ILE_MAX_RETRIES = 3
+ILE_RETRY_BACKOFF = 0.5
+ILE_RETRY_BACKOFF_MAX = 10
+# сколько чекинов отправлять в ILE одновременно и не более скольких запросов в секунду (0 - без ограничения)
+PUSH_CHECK_INS_WORKERS = 4
+PUSH_CHECK_INS_RATE = 10
+# как часто (в секундах) фоновый обработчик run_sync_jobs проверяет очередь задач на обновление и через
+# сколько секунд выполняющаяся задача считается упавшей
+SYNC_JOBS_POLL_INTERVAL = 2
+SYNC_JOB_TIMEOUT = 3600
+# на сколько секунд выдается блокировка обновления эвентов (столько же другие обновления ждут его результата)
+EVENTS_SYNC_LOCK_LEASE = 1800
+# за сколько секунд до истечения токена ILE получать новый (в фоне, не дожидаясь ответа 401)
+ILE_TOKEN_RENEW_BEFORE = 60
+# сохранять замеры запусков update_events в историю (модель SyncRun) и замерять ли в них пиковую память
+SAVE_SYNC_RUNS = True
+SYNC_TELEMETRY_TRACE_MEMORY = False
+# сколько дней хранить историю запусков update_events, более старые запуски удаляются
+SYNC_RUNS_KEEP_DAYS = 30
+# кеш для индекса эвентов снэпшота, по которому обновляются отдельные эвенты, и время хранения в нем, с.
+# В индексе хранится по записи на эвент, поэтому для него нужен отдельный от default кеш без жесткого
+# ограничения на количество записей, иначе индекс не строится
+EVENTS_INDEX_CACHE = 'events_index'
+EVENTS_INDEX_CACHE_TIME = 60 * 60 * 24
+# количество эвентов на странице списка эвентов
+INDEX_EVENTS_PAGE_SIZE = 100
+# кеш для списков результатов эвентов на страницах загрузки материалов и время хранения в нем, с. Списки
+# сбрасываются при изменении результатов, поэтому кеш должен быть общим для процессов: с LocMemCache
+# списки не кешируются
+TRACES_CATALOG_CACHE = 'default'
+TRACES_CATALOG_CACHE_TIME = 60 * 60
 
 ### параметры, которые надо указать в local_settings ###
 # урл sso без / в конце